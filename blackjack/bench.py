@@ -0,0 +1,438 @@
+"""Offline benchmarks for the blackjack cog.
+
+Run from the root folder of a Red install, so that cogs.blackjack and
+cogs.utils can be imported:
+
+    python path/to/Omni-Cogs/blackjack/bench.py parser
+    python path/to/Omni-Cogs/blackjack/bench.py loadtest tables=200 seconds=60
+    python path/to/Omni-Cogs/blackjack/bench.py replay path=data/blackjack/journals/<table>.bjr
+
+name=value arguments are passed to every named benchmark that takes them.
+"""
+import asyncio
+import inspect
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.getcwd())
+
+async def send_cmd_help(ctx):  #the cog imports this from __main__
+    pass
+
+from cogs import blackjack
+
+
+MESSAGES = ["bet 50", "hit", "Stand", "I understand the rules", "double!", "bet",
+            "lol that dealer", "split split", "hit or stand?", "anyone want to surrender",
+            "gg", "bet:200", "stay", "what's the minimum bet here?", "brb"]
+
+OLD_COMMANDS = ["hit", "stand", "stay", "double", "split", "surrender"]
+
+
+def old_parse(content):
+    """The substring scan check_command and do_bet used to do"""
+    if "bet" in content.lower():
+        match = re.search(r'bet\D?(\d+)', content.lower())
+        if match:
+            return ("bet", int(match.group(1)))
+        if content.lower() == "bet":
+            return ("bet", None)
+    for com in OLD_COMMANDS:
+        if com in content.lower():
+            return (com, None)
+    return (None, None)
+
+
+def bench_parser(number=200000):
+    """Time parse_action against the old substring scan per message"""
+    def run(parse):
+        for content in MESSAGES:
+            parse(content)
+    for name, parse in (("old substring scan", old_parse), ("parse_action", blackjack.parse_action)):
+        seconds = min(timeit.repeat(lambda: run(parse), number=number // len(MESSAGES), repeat=3))
+        print("{:<20} {:8.0f} ns/message".format(name, seconds / number * 1e9))
+
+
+def legacy_shoe(decks):
+    """The list of Card objects Shoe used to hold"""
+    cards = []
+    for _ in range(decks):
+        cards.extend(blackjack.Deck().cards)
+    return cards
+
+
+def legacy_deal(cards, hands):
+    """Deal two cards to each hand the way the old Hand.add_card scored them"""
+    for _ in range(hands):
+        low = 0
+        for _ in range(2):
+            card = cards.pop()
+            low += 10 if card.rank > 10 else card.rank
+
+
+def allocated(build):
+    """Bytes still allocated by the object build() returns"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    keep = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del keep
+    return after - before
+
+
+def bench_cards(number=2000, decks=8, hands=7):
+    """Build, shuffle and deal a round from an 8 deck shoe, old cards vs new"""
+    def old():
+        cards = legacy_shoe(decks)
+        random.shuffle(cards)
+        legacy_deal(cards, hands)
+    def new():
+        shoe = blackjack.Shoe(decks)
+        shoe.shuffle()
+        for _ in range(hands):
+            shoe.move_cards(blackjack.Hand(), 2)
+    for name, run, build in (("Card objects", old, lambda: legacy_shoe(decks)),
+                             ("integer cards", new, lambda: blackjack.Shoe(decks))):
+        seconds = min(timeit.repeat(run, number=number, repeat=3))
+        print("{:<20} {:8.1f} us/round {:8d} bytes/shoe".format(name, seconds / number * 1e6, allocated(build)))
+
+
+def bench_render(number=100000):
+    """Render a three card hand the way a turn does: once per prompt, with
+    the hand unchanged between renders"""
+    owner = FakeMember(1, None)
+    hand = blackjack.Hand(owner, False, 10)
+    for card in (0, 13, 5):
+        hand.add_card(card)
+    for name, render in (("rebuilt each time", hand.render), ("cached str", hand.__str__)):
+        seconds = min(timeit.repeat(render, number=number, repeat=3))
+        print("{:<20} {:8.0f} ns/render".format(name, seconds / number * 1e9))
+
+
+class FakeServer:
+    def __init__(self, serverid):
+        self.id = str(serverid)
+
+
+class FakeMember:
+    def __init__(self, memberid, server):
+        self.id = str(memberid)
+        self.name = "player" + self.id
+        self.mention = "<@{}>".format(self.id)
+        self.server = server
+
+    def __str__(self):
+        return self.name
+
+
+class FakeChannel:
+    def __init__(self, channelid, server=None):
+        self.id = str(channelid)
+        self.name = "table-" + self.id
+        self.server = server
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMessage:
+    def __init__(self, author, channel, content):
+        self.author = author
+        self.channel = channel
+        self.server = channel.server
+        self.content = content
+
+
+class FakeContext:
+    def __init__(self, message):
+        self.message = message
+        self.prefix = "!"
+        self.invoked_subcommand = None
+
+
+class FakeBank:
+    """Stands in for Red's Economy bank, every account flush with credits"""
+
+    def __init__(self, balance=10 ** 9):
+        self.balance = balance
+        self.accounts = {}  #[server id][member id]account, like the real bank
+        self.saves = 0
+
+    def account(self, member):
+        return self.accounts.setdefault(member.server.id, {}).setdefault(
+            member.id, {"name": member.name, "balance": self.balance})
+
+    def account_exists(self, member):
+        return True
+
+    def can_spend(self, member, amount):
+        return self.account(member)["balance"] >= amount
+
+    def get_balance(self, member):
+        return self.account(member)["balance"]
+
+    def set_credits(self, member, amount):
+        self.account(member)["balance"] = amount
+        self._save_bank()
+
+    def _save_bank(self):
+        self.saves += 1
+
+
+class FakeEconomy:
+    def __init__(self):
+        self.bank = FakeBank()
+
+
+class FakeBot:
+    """Stands in for the Discord client.  Sends take latency seconds, and
+    a send beyond Discord's 5 per 5 seconds per channel is counted as a
+    429 the real API would have answered with."""
+
+    def __init__(self, loop, latency=0.05):
+        self.loop = loop
+        self.latency = latency
+        self.user = FakeMember(0, None)
+        self.cogs = {"Economy": FakeEconomy()}
+        self.listeners = []
+        self.sent = 0
+        self.said = 0
+        self.ratelimited = 0
+        self.history = {}  #[channel id][send times]
+
+    def get_cog(self, name):
+        return self.cogs.get(name)
+
+    def add_cog(self, cog):
+        self.cogs[type(cog).__name__] = cog
+
+    def add_listener(self, func, name):
+        self.listeners.append(func)
+
+    async def say(self, content=None, **kwargs):
+        self.said += 1
+        await asyncio.sleep(self.latency)
+
+    async def change_status(self, game=None, **kwargs):
+        await asyncio.sleep(self.latency)
+
+    async def send_message(self, channel, content=None, **kwargs):
+        now = self.loop.time()
+        history = self.history.setdefault(channel.id, [])
+        history.append(now)
+        if len(history) > 5 and now - history[-6] < 5:
+            self.ratelimited += 1
+        self.sent += 1
+        await asyncio.sleep(self.latency)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def bench_outbox(channels=300, seconds=10, rate=0.2):
+    """Load the shared outbox with prompts, play messages and stats from
+    many channels at rate messages per channel per second"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot = FakeBot(loop)
+    outbox = blackjack.Outbox(bot)
+    latencies = {blackjack.PRIORITY_PROMPT: [], blackjack.PRIORITY_PLAY: [], blackjack.PRIORITY_STATS: []}
+    queued = {}
+    real_send = bot.send_message
+
+    async def timed_send(channel, content=None, **kwargs):
+        priority, stamp = queued.pop(content)
+        latencies[priority].append(loop.time() - stamp)
+        await real_send(channel, content)
+    bot.send_message = timed_send
+
+    async def table(channel):
+        n = 0
+        end = loop.time() + seconds
+        while True:
+            await asyncio.sleep(min(random.expovariate(rate), end - loop.time()))
+            if loop.time() >= end:
+                return
+            n += 1
+            priority = random.choice(list(latencies))
+            content = "{} message {}".format(channel.id, n)
+            key = ("render", channel.id) if priority == blackjack.PRIORITY_PLAY else None
+            for old, (p, stamp) in list(queued.items()):  #a merge drops the older render
+                if key and p == priority and old.startswith(channel.id + " "):
+                    del queued[old]
+            queued[content] = (priority, loop.time())
+            outbox.send(channel, content, priority, key)
+
+    async def main():
+        await asyncio.gather(*[table(FakeChannel(i)) for i in range(channels)])
+        while outbox.pending():
+            await asyncio.sleep(0.1)
+        outbox.close()
+
+    start = time.perf_counter()
+    loop.run_until_complete(main())
+    elapsed = time.perf_counter() - start
+    print("{} channels, {:.1f}s: {} sent, {} merged, {} would-be 429s".format(
+        channels, elapsed, bot.sent, outbox.merged, bot.ratelimited))
+    for priority, values in sorted(latencies.items()):
+        print("priority {}: p50 {:6.3f}s  p99 {:6.3f}s".format(priority, percentile(values, 50), percentile(values, 99)))
+    loop.close()
+
+
+PLAY_ACTIONS = ["hit", "hit", "stand", "stand", "stay", "double", "split", "surrender"]
+CHATTER = ["gg", "lol that dealer", "brb", "nice hand", "hit or stand?", "anyone else here?"]
+
+
+def command(cog, name):
+    """The cog's command callback, callable with a context like Red does"""
+    attr = getattr(type(cog), name)
+    return getattr(attr, "callback", attr).__get__(cog)
+
+
+async def scripted_player(member, channel, cog, rate, end):
+    """Bet when the table takes bets, play when it's our turn and chat
+    otherwise, at rate messages per second"""
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(min(random.expovariate(rate), max(0, end - loop.time())))
+        if loop.time() >= end:
+            return
+        session = cog.bj_sessions.get(channel.id)
+        if session is None:
+            return
+        if session.activeUser is member:
+            content = random.choice(PLAY_ACTIONS)
+        elif session.activeUser is None and member not in session.bets:
+            content = random.choice(["bet 10", "bet"])
+        else:
+            content = random.choice(CHATTER)
+        for listener in cog.bot.listeners:
+            await listener(FakeMessage(member, channel, content))
+
+
+def bench_loadtest(tables=50, players=4, seconds=30, rate=1.0, bettime=1, latency=0.05):
+    """Run tables tables of players scripted players each, every player
+    sending rate messages a second, against a fake bot and bank.  The cog's
+    data folder is a throwaway temp folder."""
+    home = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="blackjack-bench-")
+    os.chdir(workdir)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot = FakeBot(loop, latency)
+    blackjack.setup(bot)
+    cog = bot.cogs["Blackjack"]
+    sit = command(cog, "sit")
+    getup = command(cog, "getup")
+    hands = [0]
+    record = cog.playerstats.record
+
+    def counted(results):
+        hands[0] += sum(result[5] for result in results)
+        record(results)
+    cog.playerstats.record = counted
+
+    servers = [FakeServer(i) for i in range(max(1, tables // 10))]
+    for server in servers:
+        settings = cog.settings.get(server)
+        settings["BET_TIMEOUT"] = bettime  #below blackjackset's floor so rounds turn over quickly
+    channels = [FakeChannel(i + 1, servers[i % len(servers)]) for i in range(tables)]
+    seated = {channel.id: [FakeMember(int(channel.id) * 100 + seat, channel.server) for seat in range(players)]
+              for channel in channels}
+
+    async def main():
+        blackjack.metrics.start(loop, cog.table_gauges)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for channel in channels:
+            for seat, member in enumerate(seated[channel.id], 1):
+                await sit(FakeContext(FakeMessage(member, channel, "!sit")), seat)
+        await asyncio.sleep(bettime + 0.5)  #first round dealt, so the tables hold hands and shoes
+        pertable = (tracemalloc.get_traced_memory()[0] - before) / tables
+        tracemalloc.stop()
+        blackjack.metrics.reset()
+        bot.sent = bot.ratelimited = 0
+        hands[0] = 0
+        start = loop.time()
+        end = start + seconds
+        await asyncio.gather(*[scripted_player(member, channel, cog, rate, end)
+                               for channel in channels for member in seated[channel.id]])
+        elapsed = loop.time() - start
+        snapshot = blackjack.metrics.snapshot(cog.table_gauges())
+        for channel in channels:
+            for member in seated[channel.id]:
+                await getup(FakeContext(FakeMessage(member, channel, "!getup")))
+        while cog.bj_sessions or cog.outbox.pending():
+            await asyncio.sleep(0.1)
+        blackjack.metrics.stop()
+        return elapsed, pertable, snapshot
+
+    try:
+        elapsed, pertable, snapshot = loop.run_until_complete(main())
+        cog._Blackjack__unload()
+        loop.run_until_complete(asyncio.sleep(0.1))
+    finally:
+        os.chdir(home)
+        shutil.rmtree(workdir, ignore_errors=True)
+        loop.close()
+    latency = snapshot["latency_ms"]
+    print("{} tables x {} players, {:.0f}s at {} messages/s per player".format(tables, players, elapsed, rate))
+    print("{} hands: {:.1f} hands/s, {:.0f} messages parsed/s".format(
+        hands[0], hands[0] / elapsed, snapshot["counters"].get("messages parsed", 0) / elapsed))
+    print("{} sent, {} would-be 429s, {:.1f} KiB per table".format(bot.sent, bot.ratelimited, pertable / 1024))
+    for name in ("response", "loop lag", "deal", "settle", "bank"):
+        if name in latency:
+            h = latency[name]
+            print("{:<9} ms: p50 {:>7}  p90 {:>7}  p99 {:>7}  max {:>8}".format(
+                name, str(h["p50"]), str(h["p90"]), str(h["p99"]), str(h["max"])))
+
+
+def bench_replay(path=None, repeat=1):
+    """Replay a table's journal through the game logic at full speed"""
+    if path is None:
+        print("Name a journal to replay: replay path=data/blackjack/journals/<table>.bjr")
+        return
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        rounds, differ, table = loop.run_until_complete(blackjack.replay_journal(path))
+    elapsed = time.perf_counter() - start
+    loop.close()
+    print("{} rounds x {}: {:.0f} rounds/s, {} messages, {} rounds settled differently from the journal".format(
+        rounds, repeat, rounds * repeat / elapsed, len(table.output), differ))
+
+
+BENCHMARKS = {"parser": bench_parser, "cards": bench_cards, "outbox": bench_outbox, "render": bench_render,
+              "loadtest": bench_loadtest, "replay": bench_replay}
+
+
+def option(value):
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+
+if __name__ == "__main__":
+    names = [arg for arg in sys.argv[1:] if "=" not in arg] or sorted(BENCHMARKS)
+    options = dict(arg.split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+    for name in names:
+        print("== " + name)
+        run = BENCHMARKS[name]
+        accepted = inspect.signature(run).parameters
+        run(**{key: option(value) for key, value in options.items() if key in accepted})
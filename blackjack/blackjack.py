@@ -11,6 +11,20 @@ import time
 import random
 import asyncio
 import re
+import heapq
+import bisect
+import json
+import struct
+import sqlite3
+import tempfile
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class Blackjack:
     """Blackjack
@@ -19,22 +33,127 @@ class Blackjack:
 
     def __init__(self, bot):
         self.bot = bot
-        self.settings = fileIO("data/blackjack/settings.json", "load") 
-        self.bj_sessions = []
+        self.settings = SettingsStore(bot.loop)
+        self.bj_sessions = {} #[channel id]BlackjackSession
         self.payday_register = {}
+        self.clock = TableClock(bot.loop)
+        self.outbox = Outbox(bot)
+        self.simpool = None #one thread for simulate, started on first use.  numpy does the work without the GIL
+        self.simstop = threading.Event() #tells a running simulation to give up when the cog unloads
+        self.playerstats = StatsStore(bot.loop)
+        self.wagers = WagerLog(bot.loop)
+        self.linessaid = 0 #lines the tables said ...
+        self.messagessent = 0 #... and the messages it took to say them
         economy_cog = self.bot.get_cog("Economy")
         if economy_cog is None:
             print("Sorry, but blackjack relies on the economy cog.  Please ensure economy is loaded before loading blackjack.")
         else:
             self.bank = economy_cog.bank
 
-    @commands.group(pass_context=True)
+    def __unload(self):
+        #Pause every table and leave it on the bot, so setup() in the
+        #reloaded module can pick each one up where it stopped.
+        sessions = []
+        for session in list(self.bj_sessions.values()):
+            if not session.stop:
+                sessions.append(session.hand_off())
+            if session.task is not None:
+                session.task.cancel()
+        setattr(self.bot, HANDOFF_ATTR, {"time": self.bot.loop.time(), "sessions": sessions, "outbox": self.outbox.hand_off(),
+                                         "wagers": self.wagers.hand_off(), "settings": self.settings.servers,
+                                         "linessaid": self.linessaid, "messagessent": self.messagessent})
+        self.outbox.close()
+        self.settings.close()
+        self.playerstats.close()
+        metrics.stop()
+        if self.simpool is not None:
+            self.simstop.set()
+            self.simpool.shutdown(wait=False)
+
+    def take_over(self, handoff):
+        """Resume the tables the previous load of the cog handed off"""
+        self.settings.servers.update(handoff["settings"]) #the same dicts, so nothing is read back from disk
+        self.outbox.take_over(handoff["outbox"])
+        self.wagers.take_over(handoff["wagers"])
+        self.linessaid = handoff["linessaid"]
+        self.messagessent = handoff["messagessent"]
+        for state in handoff["sessions"]:
+            session = restore_session(state, self)
+            self.bj_sessions[session.channel.id] = session
+            session.task = self.bot.loop.create_task(session.dealer_waiting(resume=True))
+        logger.info("Blackjack resumed {} tables after a reload".format(str(len(handoff["sessions"]))))
+
+    async def recover_wagers(self):
+        """Settle the rounds the wager log shows were cut short, as when the
+           bot crashed mid round.  Run at startup, before any table opens.
+
+        Bets aren't taken from the bank until a round settles, so a round
+        that never dealt has nothing to give back.  A round with its
+        settlement logged is settled to those balances.  One that dealt but
+        didn't settle is replayed from its logged cards and actions.  Only
+        the hands the players finished are settled; a hand that was still
+        being played, or wasn't reached, is void and its stake stays with
+        the player.  A balance is only changed while it is still what the
+        round started from, so running this again, or after the bank was
+        saved, changes nothing.  A round that can't be replayed, or has a
+        player without an account, stays in the log for a later run or an
+        operator to settle."""
+        if not hasattr(self, "bank"):
+            return
+        rounds = read_wagers(self.wagers.path)
+        table = ReplayTable(self.bot.loop)
+        nets = {}
+        for roundid, logged in rounds.items():
+            if logged["done"] or logged["deal"] is None:
+                continue
+            channelid, serverid, seed, dealt, decks, penetration = logged["deal"]
+            server = discord.Object(id=str(serverid))
+            if logged["settles"]:
+                targets = logged["settles"]
+            else:
+                journaled = {"seed": seed, "dealt": dealt, "decks": decks, "penetration": penetration,
+                             "players": [(playerid, bet, balance, 0) for playerid, bet, balance in logged["stakes"]],
+                             "actions": [(0, player, code) for player, code in logged["actions"]]}
+                try:
+                    await replay_round(journaled, table, ReplayChannel(channelid), partial=True)
+                except ValueError as e:
+                    logger.info("Blackjack could not recover round {} in channel {}: {}.  It stays in the wager log.".format(
+                                str(roundid), str(channelid), str(e)))
+                    self.wagers.keep(roundid, logged)
+                    continue
+                targets = [(playerid, balance, table.bank.balances[str(playerid)]) for playerid, bet, balance in logged["stakes"]]
+            settled = []
+            for playerid, before, after in targets:
+                player = ReplayUser(playerid)
+                player.server = server
+                if not self.bank.account_exists(player):
+                    logger.info("Blackjack found no account for player {} recovering round {}.  It stays in the wager log.".format(
+                                player.id, str(roundid)))
+                    self.wagers.keep(roundid, logged)
+                    continue
+                balance = self.bank.get_balance(player)
+                if balance == before and after != before:
+                    nets[player] = after - before
+                    settled.append("{} {:+d}".format(player.id, after - before))
+                elif balance != after:
+                    logger.info("Blackjack left player {}'s balance alone recovering round {}; it has moved since".format(
+                                player.id, str(roundid)))
+            logger.info("Blackjack recovered round {} in channel {}: {}".format(str(roundid), str(channelid),
+                                                                             ", ".join(settled) or "nothing owed"))
+        if nets:
+            balances, overdrawn = settle_round(self.bank, nets)
+            for player, net in overdrawn.items():
+                logger.info("Blackjack left player {}'s recovered loss of {} unsettled; their balance can't cover it".format(
+                            player.id, str(-net)))
+        self.wagers.compact()
+
+    @commands.group(pass_context=True, no_pm=True)
     @checks.mod_or_permissions(manage_server=True)
     async def blackjackset(self, ctx):
-        """Changes Blackjack module settings"""
+        """Changes Blackjack module settings for this server"""
         if ctx.invoked_subcommand is None:
             msg = "```"
-            for k, v in self.settings.items():
+            for k, v in sorted(self.settings.get(ctx.message.server).items()):
                 msg += str(k) + ": " + str(v) + "\n"
             msg += "\nType {}help blackjackset to see the list of commands.```".format(ctx.prefix)
             await self.bot.say(msg)
@@ -46,9 +165,8 @@ class Blackjack:
         if seconds <= 30:
             await self.bot.say("Timeout interval must be more than 30")
             return
-        self.settings["ACTIVE_TIMEOUT"] = seconds
-        await self.bot.say("Blackjack activity timeout is now: " + str(self.settings["ACTIVE_TIMEOUT"]))
-        fileIO("data/blackjack/settings.json", "save", self.settings)
+        self.settings.set(ctx.message.server, "ACTIVE_TIMEOUT", seconds)
+        await self.bot.say("Blackjack activity timeout is now: " + str(seconds))
 
     @blackjackset.command(name="bettime", pass_context=True)
     async def bettime(self, ctx, seconds : int):
@@ -57,9 +175,8 @@ class Blackjack:
         if seconds < 5:
             await self.bot.say("Bet timeout interval must be more than 5")
             return
-        self.settings["BET_TIMEOUT"] = seconds
-        await self.bot.say("Blackjack bet timeout is now: " + str(self.settings["BET_TIMEOUT"]))
-        fileIO("data/blackjack/settings.json", "save", self.settings)
+        self.settings.set(ctx.message.server, "BET_TIMEOUT", seconds)
+        await self.bot.say("Blackjack bet timeout is now: " + str(seconds))
 
     @blackjackset.command(name="delay", pass_context=True)
     async def delay(self, ctx, seconds : int):
@@ -68,9 +185,8 @@ class Blackjack:
         if seconds < 10:
             await self.bot.say("Activity delay must be more than 10")
             return
-        self.settings["ACTIVE_DELAY"] = seconds
-        await self.bot.say("Active user delay is now: " + str(self.settings["ACTIVE_DELAY"]))
-        fileIO("data/blackjack/settings.json", "save", self.settings)
+        self.settings.set(ctx.message.server, "ACTIVE_DELAY", seconds)
+        await self.bot.say("Active user delay is now: " + str(seconds))
 
     @blackjackset.command(name="minbet", pass_context=True)
     async def minbet(self, ctx, minbet : int):
@@ -79,24 +195,22 @@ class Blackjack:
         if minbet <= 0:
             await self.bot.say("Minmum bet must be more than 0!")
             return
-        self.settings["MIN_BET"] = minbet
-        await self.bot.say("Minimum blackjack bet is now: " + str(self.settings["MIN_BET"]))
-        fileIO("data/blackjack/settings.json", "save", self.settings)
+        self.settings.set(ctx.message.server, "MIN_BET", minbet)
+        await self.bot.say("Minimum blackjack bet is now: " + str(minbet))
 
     @blackjackset.command(name="maxbet", pass_context=True)
     async def maxbet(self, ctx, maxbet : int):
         """Maximum bet.
         """
-        minbet = self.settings["MIN_BET"]
+        minbet = self.settings.get(ctx.message.server)["MIN_BET"]
         if maxbet < 100:
             await self.bot.say("Maximum bet must be more than 100!")
             return
         if maxbet < minbet:
             await self.bot.say("Maximum bet must be higher than the minimum!")
             return
-        self.settings["MAX_BET"] = maxbet
-        await self.bot.say("Maximum blackjack bet is now: " + str(self.settings["MAX_BET"]))
-        fileIO("data/blackjack/settings.json", "save", self.settings)
+        self.settings.set(ctx.message.server, "MAX_BET", maxbet)
+        await self.bot.say("Maximum blackjack bet is now: " + str(maxbet))
 
     @blackjackset.command(name="decks", pass_context=True)
     async def decks(self, ctx, decks : int):
@@ -105,9 +219,89 @@ class Blackjack:
         if decks < 1 or decks > 8:
             await self.bot.say("Number of decks must be between 1 and 8 inclusive")
             return
-        self.settings["DECKS"] = decks
-        await self.bot.say("Number of decks is now: " + str(self.settings["DECKS"]))
-        fileIO("data/blackjack/settings.json", "save", self.settings)
+        settings = self.settings.get(ctx.message.server)
+        self.settings.set(ctx.message.server, "DECKS", decks)
+        msg = "Number of decks is now: " + str(decks)
+        if settings["SEATS"] > SEATS_PER_DECK * decks:
+            self.settings.set(ctx.message.server, "SEATS", SEATS_PER_DECK * decks)
+            msg += "\nNumber of seats is now: " + str(SEATS_PER_DECK * decks)
+        await self.bot.say(msg)
+
+    @blackjackset.command(name="penetration", pass_context=True)
+    async def penetration(self, ctx, percent : int):
+        """Percent of the shoe dealt before the cut card comes up.
+        """
+        if percent < 50 or percent > 90:
+            await self.bot.say("Penetration must be between 50 and 90 percent")
+            return
+        self.settings.set(ctx.message.server, "PENETRATION", percent)
+        await self.bot.say("Shoe penetration is now: " + str(percent) + "%")
+
+    @blackjackset.command(name="seats", pass_context=True)
+    async def seats(self, ctx, seats : int):
+        """Seats at each table, up to 7 per deck.  New tables get the new size.
+        """
+        if seats < 1 or seats > 24:
+            await self.bot.say("Number of seats must be between 1 and 24 inclusive")
+            return
+        decks = self.settings.get(ctx.message.server)["DECKS"]
+        if seats > SEATS_PER_DECK * decks:
+            await self.bot.say("A {}-deck shoe seats at most {}.  Add decks first.".format(str(decks), str(SEATS_PER_DECK * decks)))
+            return
+        self.settings.set(ctx.message.server, "SEATS", seats)
+        await self.bot.say("Number of seats is now: " + str(seats))
+
+    @blackjackset.command(name="turbo", pass_context=True)
+    async def turbo(self, ctx):
+        """Turns turbo on or off for this channel's table.
+           Turbo deals once everyone seated has bet, skips the dealer's pause,
+           and takes a player's whole turn in one message, like 'hit hit stand'
+           or 'hit until 17'.
+        """
+        channel = ctx.message.channel
+        turbo = [channelid for channelid in self.settings.get(ctx.message.server)["TURBO"] if channelid != channel.id]
+        on = len(turbo) == len(self.settings.get(ctx.message.server)["TURBO"])
+        if on:
+            turbo.append(channel.id)
+        self.settings.set(ctx.message.server, "TURBO", turbo)
+        await self.bot.say("Turbo is now " + ("on" if on else "off") + " at this channel's table.")
+
+    @blackjackset.command(name="simulate", pass_context=True)
+    async def simulate(self, ctx, hands : int=1000000):
+        """Simulates hands to estimate the house edge under the current settings.
+        """
+        if numpy is None:
+            await self.bot.say("The simulator needs numpy.  Install it with: pip3 install numpy")
+            return
+        if hands < 1000 or hands > 20000000:
+            await self.bot.say("Number of hands must be between 1000 and 20000000")
+            return
+        try:
+            load_strategy()
+        except (OSError, ValueError):
+            await self.bot.say("The simulator plays basic strategy, but the strategy tables aren't installed.")
+            return
+        if self.simpool is None:
+            self.simpool = ThreadPoolExecutor(max_workers=1)
+        settings = self.settings.get(ctx.message.server)
+        decks = settings["DECKS"]
+        await self.bot.say("Simulating {} hands with {} decks...".format(str(hands), str(decks)))
+        start = time.perf_counter()
+        stats = await self.bot.loop.run_in_executor(self.simpool, simulate_rounds, decks, hands, None, 100000, self.simstop)
+        if self.simstop.is_set(): #the cog unloaded part way
+            return
+        stats = combine_stats([stats])
+        elapsed = time.perf_counter() - start
+        msg = "```Simulated {} rounds ({} hands) with {} decks in {:.1f}s\n".format(str(stats["rounds"]), str(stats["hands"]), str(decks), elapsed)
+        msg += "House edge: {:.2f}% (negative means the players win)\n".format(stats["edge"] * 100)
+        msg += "Standard deviation: {:.2f} bets per round\n".format(stats["variance"] ** 0.5)
+        msg += "Player busts: {:.1f}% of hands\n".format(stats["player_busts"] * 100 / stats["hands"])
+        msg += "Dealer busts: {:.1f}% of the hands the dealer plays out\n".format(stats["dealer_busts"] * 100 / max(1, stats["dealer_hands"]))
+        msg += "Blackjacks: {:.2f}% player, {:.2f}% dealer\n".format(stats["player_blackjacks"] * 100 / stats["hands"], stats["dealer_blackjacks"] * 100 / stats["rounds"])
+        msg += "Per 1000 rounds the house keeps {:.0f} credits at the {} minimum and {:.0f} at the {} maximum```".format(
+            stats["edge"] * settings["MIN_BET"] * 1000, str(settings["MIN_BET"]),
+            stats["edge"] * settings["MAX_BET"] * 1000, str(settings["MAX_BET"]))
+        await self.bot.say(msg)
 
     @commands.group(name="blackjack", pass_context=True)
     async def _blackjack(self, ctx):
@@ -116,77 +310,167 @@ class Blackjack:
         Step 1:  '!bank register' to open a blackjack account.
         Step 2:  '!payday' will get you some credits!
         Step 3:  '!sit' to start a game (or join an existing one).  
-            3a:   Pick a seat [1-6] when you '!sit' or the dealer will pick for you.
+            3a:   Pick a seat when you '!sit' or the dealer will pick for you.
         Step 4:   Place a 'bet' at the table and follow dealer instructions from there.  
         Step 5:  '!getup' when you're finished playing, or just let yourself time out.
         """
         if ctx.invoked_subcommand is None:
             await send_cmd_help(ctx)
+            settings = self.settings.get(ctx.message.server)
+            seats = min(settings["SEATS"], SEATS_PER_DECK * settings["DECKS"])
+            await self.bot.say("Seats on this server run from 1 to {}.".format(str(seats)))
 
     @_blackjack.command(pass_context=True)    
     @checks.mod_or_permissions(manage_server=True)
     async def stop(self, ctx):
         """Stops the current channel's blackjack table"""
         message = ctx.message
-        if await get_bj_by_channel(message.channel):
-            s = await get_bj_by_channel(message.channel)
-            s.status = "stopping"
+        s = get_bj_by_channel(message.channel)
+        if s:
             s.stop = True
+            s.notify()
             await self.bot.say("Blackjack stopping...")
         else:
             await self.bot.say("There's no blackjack table started in this channel.")
 
+    @_blackjack.command(pass_context=True)
+    @checks.mod_or_permissions(manage_server=True)
+    async def metrics(self, ctx, action : str=None):
+        """Table performance metrics.  on, off or reset to control collection."""
+        if action == "on":
+            metrics.start(self.bot.loop, self.table_gauges)
+            await self.bot.say("Collecting blackjack metrics, logged every {} seconds.".format(str(METRICS_DUMP_INTERVAL)))
+        elif action == "off":
+            metrics.stop()
+            await self.bot.say("Blackjack metrics off.")
+        elif action == "reset":
+            metrics.reset()
+            await self.bot.say("Blackjack metrics reset.")
+        elif not metrics.enabled:
+            await self.bot.say("Blackjack metrics are off.  Turn them on with {}blackjack metrics on".format(ctx.prefix))
+        else:
+            await self.bot.say("```" + metrics.report(self.table_gauges())[:MESSAGE_LIMIT - 6] + "```")
+
+    def table_gauges(self):
+        """Current state of every table, read when metrics are reported"""
+        tables = {}
+        for channelid, session in self.bj_sessions.items():
+            queue = self.outbox.channels.get(channelid)
+            tables[str(session.channel)] = {"players": len(session.seats), "bets": len(session.bets),
+                                            "status": session.status, "rounds": session.count,
+                                            "queued": len(queue.pending) if queue else 0,
+                                            "inbox": session.inbox.qsize(), "dropped": session.dropped}
+        return tables
+
     @_blackjack.command(pass_context=True)
     @checks.mod_or_permissions(manage_server=True)
     async def sessions(self):
         """Displays the number of sessions"""
         sessions = len(self.bj_sessions)
-        await self.bot.say("Sessions: "+str(sessions))
+        await self.bot.say("Sessions: {0}\nMessages sent: {1} for {2} lines ({3} calls saved)\n"
+                           "Outbox: {4} queued, {5} merged, {6} held back by rate limits".format(
+            str(sessions), str(self.messagessent), str(self.linessaid), str(self.linessaid - self.messagessent),
+            str(self.outbox.pending()), str(self.outbox.merged), str(self.outbox.limited)))
         channels = []
-        for sess in self.bj_sessions:
+        for sess in self.bj_sessions.values():
             channels.append(str(sess.channel))
 
+    @_blackjack.command(pass_context=True, no_pm=True)
+    async def leaderboard(self, ctx, stat : str="net", scope : str="server"):
+        """Top players on this server, or every server with global.
+           Rank by net, wins, hands or blackjacks."""
+        stat = stat.lower()
+        if stat not in STATS_RANKINGS:
+            await self.bot.say("Rank by one of: " + ", ".join(STATS_RANKINGS))
+            return
+        everywhere = scope.lower() == "global"
+        rows = await self.playerstats.leaderboard(None if everywhere else ctx.message.server.id, stat)
+        if not rows:
+            await self.bot.say("Nobody has finished a hand of blackjack " + ("yet." if everywhere else "here yet."))
+            return
+        msg = "```Blackjack {}leaderboard ({})\n".format("global " if everywhere else "", stat)
+        for place, (key, value, name) in enumerate(rows, 1):
+            if everywhere:
+                server = self.bot.get_server(key[0])
+                name += " (" + (server.name if server is not None else key[0]) + ")"
+            msg += "{:>2}. {:<24} {}\n".format(place, name, str(value))
+        await self.bot.say(msg + "```")
+
+    @_blackjack.command(pass_context=True, no_pm=True)
+    async def stats(self, ctx, user : discord.Member=None):
+        """Blackjack record for you or another player"""
+        if user is None:
+            user = ctx.message.author
+        row = await self.playerstats.player(ctx.message.server.id, user.id)
+        if row is None:
+            await self.bot.say("{} hasn't finished a hand of blackjack here yet.".format(user.name))
+            return
+        rounds, hands, wins, losses, pushes, blackjacks, net = row
+        await self.bot.say("```{0}: {1} hands in {2} rounds\nWon {3}, lost {4}, pushed {5}\nBlackjacks: {6}\nNet credits: {7}```".format(
+            user.name, str(hands), str(rounds), str(wins), str(losses), str(pushes), str(blackjacks), str(net)))
+
     @commands.command(pass_context=True, no_pm=True)
-    async def sit(self, ctx, seat : int=1):
+    async def sit(self, ctx, seat : int=None):
         """Starts or joins the blackjack table!
-           Optional, pick a position [1-6] (if it's open).
+           Optional, pick a position (if it's open).  Already seated, moves you there.
         """
-        doneSeating = False
         message = ctx.message
         author = message.author
         if not self.bank.account_exists(author):
             await self.bot.say("{}, you need an account to play blackjack. Type {}bank register to open one.".format(author.mention, ctx.prefix))
             return
 
-        if await get_bj_by_channel(message.channel):
-            session = await get_bj_by_channel(message.channel)
-        else:
-            session = BlackjackSession(message, self.settings)
-            self.bj_sessions.append(session)
-        
-        players = session.bjtable.values()
-        #probably need a SEAT LOCK at some point ... 
-        if seat < 1 or seat > 6:
-            await self.bot.say("Sorry, but please pick a seat between 1 and 6.")
-        elif author in players:
-           await self.bot.say("This isn't musical chairs! Why don't you stay where you are?!")
-           #perhaps you'd like to move seats?  program that later
-        else:
-            if seat not in session.bjtable.keys():
-                session.bjtable[seat] = author
-                await self.bot.say("Seated player {0} at position {1}.".format(author.name, str(seat)))
-                doneSeating = True
+        session = get_bj_by_channel(message.channel)
+        if not session or session.stop: #a table that's closing can't take new players
+            session = BlackjackSession(message, self.settings.get(message.server))
+            session.journal = RoundJournal(self.bot.loop, message.channel.id, session.seed)
+            self.bj_sessions[message.channel.id] = session
+        seats = session.seats
+        #Nothing below awaits until the seat is taken and the dealer started,
+        #so concurrent sits and getups can't interleave with it.
+        if seat is not None and (seat < 1 or seat > seats.size):
+            await self.bot.say("Sorry, but please pick a seat between 1 and {}.".format(str(seats.size)))
+        elif author in seats:
+            if seat is None or seat == seats.seat_of(author):
+                await self.bot.say("This isn't musical chairs! Why don't you stay where you are?!")
+            elif seats.move(author, seat):
+                await self.bot.say("Moved player {0} to position {1}.".format(author.name, str(seat)))
             else:
-                newseat = 1
-                while newseat <= 6 and not doneSeating:
-                    if newseat not in session.bjtable.keys():
-                        session.bjtable[newseat] = author
-                        doneSeating = True
-                        await self.bot.say("Seated player {0} at position {1}.".format(author.name, str(newseat)))
-                    newseat += 1
-            if not doneSeating:
+                await self.bot.say("Sorry, {}, but that seat is taken.".format(author.name))
+        else:
+            taken = seats.sit(author, seat)
+            if taken is None:
                 await self.bot.say("Sorry, no more seats available!  Wait until one opens up!")
-        if not session.active and doneSeating: await session.dealer_waiting()
+                return
+            if not session.active:
+                session.active = True
+                session.task = self.bot.loop.create_task(session.dealer_waiting())
+            await self.bot.say("Seated player {0} at position {1}.".format(author.name, str(taken)))
+
+    @_blackjack.command(pass_context=True, no_pm=True)
+    async def hints(self, ctx):
+        """Turns basic strategy hints on or off for this table"""
+        session = get_bj_by_channel(ctx.message.channel)
+        if not session:
+            await self.bot.say("There's no blackjack table started in this channel.")
+            return
+        session.showhints = not session.showhints
+        await self.bot.say("Basic strategy hints are now " + ("on" if session.showhints else "off") + " at this table.")
+
+    @commands.command(pass_context=True, no_pm=True)
+    async def hint(self, ctx):
+        """What basic strategy says to do with your hand
+        """
+        author = ctx.message.author
+        session = get_bj_by_channel(ctx.message.channel)
+        if not session or session.activeUser != author or session.activehand is None:
+            await self.bot.say("Hints are for the player who's up, {}.".format(author.name))
+            return
+        advice = session.hint(session.activehand)
+        if advice is None:
+            await self.bot.say("Sorry, the basic strategy tables aren't installed.")
+            return
+        await self.bot.say("{}, basic strategy says: {}".format(author.name, advice))
 
     @commands.command(pass_context=True, no_pm=True)
     async def getup(self, ctx):
@@ -194,15 +478,13 @@ class Blackjack:
         """
         message = ctx.message
         author = message.author
-        if await get_bj_by_channel(message.channel):
-            session = await get_bj_by_channel(message.channel)
-            if author in session.bjtable.values():
-                for seat in session.bjtable:
-                    if session.bjtable[seat] == author:
-                        removeseat = seat
+        session = get_bj_by_channel(message.channel)
+        if session:
+            if session.seats.getup(author) is not None:
+                if len(session.seats) == 0:
+                    session.stop = True
+                    session.notify()
                 await self.bot.say("Thanks for playing.  Come back again soon, {}".format(author.name))
-                tempplayer = session.bjtable.pop(removeseat)
-                if len(session.bjtable) == 0:  session.stop = True
             else: 
                 await self.bot.say("Sorry, {}, but you're not sitting at a table.".format(author.name))
         else:
@@ -210,16 +492,29 @@ class Blackjack:
 
 
 class BlackjackSession():
-    def __init__(self, message, settings):
+    def __init__(self, message, settings, seed=None, manager=None):
         self.channel = message.channel
         self.settings = settings
-        self.commands = ["hit", "stand", "stay", "double", "split", "surrender"]
+        self.manager = manager or bj_manager #the cog, or a headless stand-in for replays
+        self.seed = seed if seed is not None else random.SystemRandom().getrandbits(64)
+        self.rng = random.Random(self.seed) #seeds every shoe this table shuffles
+        self.journal = None #RoundJournal the table's rounds are written to
+        self.round = None #RoundRecord of the round being played
+        self.wagerid = None #the round's id in the wager log, from its first bet
+        self.partial = False #the script is a round cut short; hands it never finished are void
+        self.script = None #deque of journaled (player, action) a replay plays from
         self.stop = False
-        self.dealerReady = True
-        self.betReady = False
         self.status = "awaiting bets"
-        self.timer = None
-        self.bettimer = None
+        self.wake = asyncio.Event() #set when the inbox gets an action, or the table stops
+        self.inbox = asyncio.Queue(maxsize=INBOX_SIZE) #TableActions for the dealer task, the only consumer
+        self.inboxkeys = set() #actions in the inbox, so repeats of one still waiting are dropped
+        self.dropped = 0 #actions dropped as repeats or because the inbox was full
+        self.turnaction = None #the active player's action, taken by the turn they're playing
+        self.plan = None #deque of the steps a turbo player sent for the rest of their turn
+        self.expired = False #set by the table clock when a wait runs out
+        self.deadline = None #loop time the wait in progress runs out
+        self.betwindow = False #the wait in progress is the bet window
+        self.task = None
         self.count = 0 #hands played
         self.pbjcount = 0 #player blackjacks
         self.dbjcount = 0 #dealer blackjacks
@@ -228,185 +523,385 @@ class BlackjackSession():
         self.startbal = {} #[player]balance
         self.hands = {} #[player][[Hands]]
         self.blackjacks = [] #[user]
-        self.shoe = Shoe() #shoe of 1 Decks()
+        self.shoe = None #persists between rounds until the cut card comes up
+        self.nextshoe = None #future for the replacement shoe being shuffled
         self.active = False
         self.activeUser = None
-        self.bjtable = {} #[seat1-6]player
+        self.seats = SeatMap(min(settings["SEATS"], SEATS_PER_DECK * settings["DECKS"]))
         self.dealerhand = None 
-        self.splitcount = 0
+        self.turns = deque() #(player, hand index, show the table first) turns still to play this round
+        self.turn = None #the turn being played
+        self.resumewait = None #seconds left on the wait a handed-off table was paused in
+        self.activehand = None #hand the active user is playing
+        self.showhints = False #basic strategy advice with each prompt
+        self.output = [] #lines said since the last flush
+        self.actionstamp = None #loop time of the oldest player action not yet answered, for metrics
+        self.linessaid = 0
+        self.messagessent = 0
+
+    def say(self, content):
+        """Queue a line for this table's channel; flush() sends it"""
+        self.output.append(str(content))
+
+    def flush(self, priority=None, key=None):
+        """Send everything said since the last flush as few messages as
+        Discord's 2000 character limit allows, through the cog's outbox.
+        key lets a newer single-message flush replace one still queued."""
+        if priority is None:
+            priority = PRIORITY_PLAY
+        if not self.output:
+            return
+        lines = self.output
+        self.output = []
+        chunks = pack_lines(lines)
+        self.linessaid += len(lines)
+        self.messagessent += len(chunks)
+        self.manager.linessaid += len(lines)
+        self.manager.messagessent += len(chunks)
+        if len(chunks) > 1:
+            key = None
+        stamp = self.actionstamp
+        self.actionstamp = None
+        for chunk in chunks:
+            self.manager.outbox.send(self.channel, chunk, priority, key, stamp)
+            stamp = None
+
+    def notify(self):
+        """Wake the dealer so it looks at the table right away"""
+        self.wake.set()
+
+    def expire(self):
+        """Table clock callback for a wait that ran out"""
+        self.expired = True
+        self.wake.set()
+
+    async def wait_until(self, done, seconds):
+        """Handle inbox actions until done() is true or seconds pass,
+           whichever is first.  Returns done() so callers can tell a timeout apart."""
+        self.flush(PRIORITY_PROMPT) #anything said so far is what the players are waiting on
+        if self.script is not None: #replays run at full speed
+            return done()
+        if self.resumewait is not None: #what was left of the wait a handed-off table was paused in
+            seconds = min(seconds, self.resumewait)
+            self.resumewait = None
+        self.expired = False
+        self.deadline = self.manager.bot.loop.time() + seconds
+        timer = self.manager.clock.schedule(seconds, self.expire)
+        try:
+            while not done() and not self.expired:
+                if self.inbox.empty():
+                    self.wake.clear()
+                    await self.wake.wait()
+                else:
+                    self.handle(self.inbox.get_nowait())
+        finally:
+            self.manager.clock.cancel(timer)
+            self.deadline = None
+        return done()
 
     async def check_command(self, message):
-        foundcom = False
-        if message.author in self.bjtable.values():
-            if "bet" in message.content.lower():
-                await self.do_bet(message)
-            #if "bug" in message.content.lower():
-            #    print("**** Someone mentioned a BUG *****")
-        if message.author == self.activeUser:
-            for com in self.commands:
-                if com in message.content.lower():
-                    foundcom = True
-                    if com == "hit":  self.status = "hitting"
-                    if com == "stay":  self.status = "standing"
-                    if com == "stand":  self.status = "standing"
-                    if com == "split":  self.status = "splitting"
-                    if com == "double":  self.status = "doubling"
-                    if com == "surrender":  self.status = "surrendering"
-                    return True
-        #add a "confused" status if more than one command present?
-
-    async def do_bet(self, message):
-        """Establish a bet on the table"""
+        """Listener side: parse a message and post what it asks for to the inbox"""
+        metrics.count("messages parsed")
+        action, amount = parse_action(message.content)
+        if action is None:
+            return
         author = message.author
-        channel = message.channel
-        
-        match = re.search(r'bet\D?(\d+)', message.content.lower())
-        if match: 
-            bet = int(match.group(1))
-        else: 
-            if message.content.lower() == "bet" and author in self.lastbets.keys():
-                    bet = self.lastbets[author]  #repeat previous
-            else:
+        if action == "bet":
+            if author in self.seats:
+                self.post(TableAction("bet", author, amount))
+        elif author == self.activeUser:
+            self.post(TableAction(action, author, amount if action == "plan" else None))
+
+    def post(self, action):
+        """Queue an action for the dealer task.  A repeat of an action still
+           waiting, or anything past a full inbox, is dropped."""
+        key = (action.kind, action.player.id, action.amount)
+        if key in self.inboxkeys or self.inbox.full():
+            self.dropped += 1
+            metrics.count("actions dropped")
+            return
+        self.inboxkeys.add(key)
+        self.inbox.put_nowait(action)
+        self.stamp_action()
+        self.wake.set()
+
+    def handle(self, action):
+        """Dealer side: act on one TableAction from the inbox"""
+        self.inboxkeys.discard((action.kind, action.player.id, action.amount))
+        if action.kind == "bet":
+            self.do_bet(action.player, action.amount)
+        elif action.player != self.activeUser: #their turn ended while it waited
+            return
+        elif action.kind == "ambiguous" or (action.kind == "plan" and not self.turbo()):
+            self.say("{}, one action at a time please!".format(action.player.mention))
+            self.flush(key=("confused", action.player.id))
+        elif action.kind == "plan":
+            if self.plan is None and self.turnaction is None:
+                self.plan = deque(action.amount)
+        elif self.turnaction is None:
+            self.turnaction = action.kind
+
+    def stamp_action(self):
+        metrics.count("commands dispatched")
+        if metrics.enabled and self.actionstamp is None:
+            self.actionstamp = self.manager.bot.loop.time()
+
+    def do_bet(self, author, bet=None):
+        """Establish a bet on the table.  No amount repeats the last bet."""
+        if bet is None:
+            if author not in self.lastbets:
                 return
-        
-        if not bj_manager.bank.account_exists(author):
-            await bj_manager.bot.send_message(channel, "{} You need an account to play blackjack. Type {}bank register to open one.".format(author.mention, ctx.prefix))
+            bet = self.lastbets[author]
+        self.place_bet(author, bet)
+        self.flush(key=("bet", author.id))
+
+    def place_bet(self, author, bet):
+        """Check and record a bet, queueing the dealer's reply"""
+        start = time.perf_counter()
+        exists = self.manager.bank.account_exists(author)
+        spendable = exists and self.manager.bank.can_spend(author, bet)
+        metrics.since("bank", start)
+        if not exists:
+            self.say("{} You need an account to play blackjack. Type bank register to open one.".format(author.mention))
             return
-        if bj_manager.bank.can_spend(author, bet):
+        if spendable:
             if bet >= self.settings["MIN_BET"] and bet <= self.settings["MAX_BET"]:
                 if self.status == "awaiting bets" or self.status == "active bets":  
                     self.status = "active bets"
-                    await bj_manager.bot.send_message(channel, "Bet {2} accepted, dealing soon.  {0}'s balance is: {1}".format(author.name, str(bj_manager.bank.get_balance(author)), str(bet)))
+                    if self.wagerid is None:
+                        self.wagerid = self.manager.wagers.open_round()
+                    self.manager.wagers.bet(self.wagerid, author, bet)
+                    self.say("Bet {2} accepted, dealing soon.  {0}'s balance is: {1}".format(author.name, str(self.manager.bank.get_balance(author)), str(bet)))
                     self.bets[author] = bet
-                    self.betReady = True
                     if author not in self.startbal:
-                        self.startbal[author] = bj_manager.bank.get_balance(author)
+                        self.startbal[author] = self.manager.bank.get_balance(author)
+                    self.notify()
                 else:
-                    await bj_manager.bot.send_message(channel, "Sorry, {}, but please wait until I'm accepting bets!".format(author.mention))
+                    self.say("Sorry, {}, but please wait until I'm accepting bets!".format(author.mention))
             else:
-                await bj_manager.bot.send_message(channel, "{0} Bid must be between {1} and {2}.".format(author.mention, self.settings["MIN_BET"], self.settings["MAX_BET"]))
+                self.say("{0} Bid must be between {1} and {2}.".format(author.mention, self.settings["MIN_BET"], self.settings["MAX_BET"]))
         else:
-            await bj_manager.bot.send_message(channel, "{0} You need an account with enough funds to play the blackjack table.".format(author.mention))
-
-    async def dealer_waiting(self):
-        """Bulk of the while loop for the dealer wait period"""
+            self.say("{0} You need an account with enough funds to play the blackjack table.".format(author.mention))
+
+    async def dealer_waiting(self, resume=False):
+        """The table's task.  A round that raises closes the table rather
+           than leaving it seated and stuck."""
+        try:
+            await self.run_table(resume)
+        except asyncio.CancelledError:
+            raise #handed off to a reloaded cog, or unloaded
+        except Exception:
+            logger.exception("Blackjack table in {} failed".format(str(self.channel)))
+            await self.abandon()
+
+    async def run_table(self, resume=False):
+        """Runs the table: wait for a bet, hold the bet window open, deal, repeat.
+           resume picks up a table handed off by the cog before a reload."""
         self.active = True
-        self.status = "awaiting bets"
-        self.timer = int(time.perf_counter())        
-        await bj_manager.bot.change_status(discord.Game(name="Blackjack"))
-        while not self.stop and abs(self.timer - int(time.perf_counter())) <= self.settings["ACTIVE_TIMEOUT"]:
-            if self.dealerReady: await bj_manager.bot.say("Dealer Ready!  Place your bets now please.")
-            self.dealerReady = False
-            await asyncio.sleep(1)
-            if self.status == "active bets":
-                self.status == "dealing"
-                self.bettimer = int(time.perf_counter())
-                self.betReady = True
-                while abs(self.bettimer - int(time.perf_counter())) <= self.settings["BET_TIMEOUT"]:
-                    if self.betReady: 
-                        endtime = self.settings["BET_TIMEOUT"] - abs(self.bettimer - int(time.perf_counter()))
-                        await bj_manager.bot.say("Betting ends in {} seconds".format(str(endtime)))
-                        self.betReady = False
-                    await asyncio.sleep(1)
-                await self.init_deal()
-            elif self.stop:
-                await self.stop_bj()
-        if not self.stop:
-            await bj_manager.bot.say("Sorry, you took too long to bet!  Closing table.")
-            await self.stop_bj()
+        if not resume:
+            self.status = "awaiting bets"
+            await self.manager.bot.change_status(discord.Game(name="Blackjack"))
+            metrics.count("api calls")
+        self.prepare_shoe()
+        ready = await self.resume_round() if resume else True
+        while not self.stop:
+            if ready:
+                self.say("Dealer Ready!  Place your bets now please.")
+            ready = True
+            if not await self.wait_until(lambda: self.stop or self.status == "active bets", self.settings["ACTIVE_TIMEOUT"]):
+                self.say("Sorry, you took too long to bet!  Closing table.")
+                break
+            if self.stop:
+                break
+            if not self.turbo():
+                self.say("Betting ends in {} seconds".format(str(self.settings["BET_TIMEOUT"])))
+                await self.bet_window()
+            elif not self.all_bet():
+                self.say("Betting ends in {} seconds, or once everyone has bet".format(str(self.settings["BET_TIMEOUT"])))
+                await self.bet_window()
+            await self.init_deal()
+        await self.stop_bj()
+
+    async def bet_window(self):
+        self.betwindow = True
+        await self.wait_until(lambda: self.stop or (self.turbo() and self.all_bet()), self.settings["BET_TIMEOUT"])
+        self.betwindow = False
+
+    def turbo(self):
+        return self.channel.id in self.settings["TURBO"]
+
+    def all_bet(self):
+        """Everyone seated has a bet down"""
+        return all(player in self.bets for player in self.seats.players.values())
+
+    async def resume_round(self):
+        """Finish the round a handed-off table was paused in.  Returns False
+           if it was paused waiting for a first bet, and Dealer Ready was said."""
+        if self.status == "finishing":
+            await self.finish_deal(revealed=True)
+        elif self.status == "dealing" and self.hands:
+            await self.play_turns()
+        elif self.status == "dealing": #paused for the next shoe
+            await self.init_deal()
+        elif self.betwindow:
+            await self.bet_window()
+            await self.init_deal()
+        elif self.resumewait is not None:
+            return False
+        return True
         
     async def active_dealer(self, splitindex):
-        """Bulk of the while loop for the active dealer loop"""
-        self.timer = int(time.perf_counter()) #reset timer
-        if self.hands[self.activeUser][splitindex].isBlackjack:
-            self.hands[self.activeUser][splitindex].bet *= 2
-            await bj_manager.bot.say("BLACKJACK!  Congrats, {}.".format(self.activeUser.mention))  
+        """Run one player's turn on one hand, waiting for their commands"""
+        hand = self.hands[self.activeUser][splitindex]
+        self.activehand = hand
+        if hand.isBlackjack:
+            hand.bet *= 2
+            self.say("BLACKJACK!  Congrats, {}.".format(self.activeUser.mention))  
             self.pbjcount += 1
             self.blackjacks.append(self.activeUser)
-            self.timer -= self.settings["ACTIVE_DELAY"] #unnecessary
-            self.status = "blackjack"
-        else:
-            await bj_manager.bot.say("{}, you're up!  What action would you like to perform now?".format(self.activeUser.mention))
-            while not self.stop and abs(self.timer - int(time.perf_counter())) <= self.settings["ACTIVE_DELAY"]:
-                if abs(self.timer - int(time.perf_counter())) == self.settings["ACTIVE_DELAY"]:
-                    await bj_manager.bot.say("{} timed out.".format(self.activeUser.name))
-                    self.status = "standing"
-                if self.status == "hitting":
-                    await self.do_hit(splitindex)
-                elif self.status == "standing":
-                    await bj_manager.bot.say("{} stands.".format(self.activeUser.name))
-                    self.timer -= self.settings["ACTIVE_DELAY"]
-                    self.status = "dealing"
-                elif self.status == "doubling":
-                    if len(self.hands[self.activeUser][splitindex]) == 2:
-                        if bj_manager.bank.can_spend(self.activeUser, self.bets[self.activeUser]*2):
-                            self.hands[self.activeUser][splitindex].bet *= 2
-                            await self.do_hit(splitindex)
-                            self.timer -= self.settings["ACTIVE_DELAY"]
-                        else: 
-                            await bj_manager.bot.say("Not enough funds, you can just hit instead")
-                    else:
-                        await bj_manager.bot.say("Sorry, but you can only double down on your initial two card hand.  Try hitting.")
-                    self.status = "dealing"
-                elif self.status == "splitting":
-                    if self.hands[self.activeUser][splitindex].isSplittable():
-                        if bj_manager.bank.can_spend(self.activeUser, self.hands[self.activeUser][splitindex].bet*2):
-                            await self.do_split(splitindex)
-                            return #escape this active_deal, do_split calls two new ones!
-                        else:
-                            await bj_manager.bot.say("Not enough funds, you can just hit/stay instead")
-                    else:
-                        await bj_manager.bot.say("Sorry, but that is not a splittable hand!")
-                    self.status = "dealing"
-                elif self.status == "surrendering":
-                    if len(self.hands[self.activeUser][splitindex]) == 2:
-                        await bj_manager.bot.say("{} surrenders and gets half their bet back.".format(self.activeUser.name))
-                        self.hands[self.activeUser][splitindex] *= -0.5
-                        self.timer -= self.settings["ACTIVE_DELAY"]
-                    else:
-                        await bj_manager.bot.say("Sorry, but you can only surrender your initial hand.")
-                    self.status = "dealing"
-                await asyncio.sleep(1)
+            self.status = "dealing"
+            return
+        prompt = "{}, you're up!  What action would you like to perform now?".format(self.activeUser.mention)
+        if self.turbo():
+            prompt += "  You can send the whole turn at once, like 'hit hit stand' or 'hit until 17'."
+        if self.showhints and self.hint(hand):
+            prompt += "  (Basic strategy: {})".format(self.hint(hand))
+        self.say(prompt)
         self.status = "dealing"
-        
+        turnover = False
+        self.turnaction = None
+        self.plan = None
+        while not turnover: #a table that's stopping times everyone out, so the journal still replays
+            action = self.turnaction
+            self.turnaction = None
+            if action is None and self.partial and not self.script: #the round was cut short before this hand was finished
+                hand.bet = 0 #so its stake stays with the player
+                break
+            if action is None:
+                action = await self.player_action()
+                if action is None:
+                    self.say("{} timed out.".format(self.activeUser.name))
+                    action = "stand"
+            if action == "hit":
+                turnover = await self.do_hit(splitindex)
+            elif action == "stand":
+                self.say("{} stands.".format(self.activeUser.name))
+                turnover = True
+            elif action == "double":
+                if len(hand) == 2:
+                    if self.manager.bank.can_spend(self.activeUser, self.bets[self.activeUser]*2):
+                        hand.bet *= 2
+                        await self.do_hit(splitindex)
+                        turnover = True
+                    else: 
+                        self.say("Not enough funds, you can just hit instead")
+                else:
+                    self.say("Sorry, but you can only double down on your initial two card hand.  Try hitting.")
+            elif action == "split":
+                if hand.isSplittable():
+                    if self.manager.bank.can_spend(self.activeUser, hand.bet*2):
+                        self.do_split(splitindex)
+                        return #escape this active_deal, do_split queues two new turns!
+                    else:
+                        self.say("Not enough funds, you can just hit/stay instead")
+                else:
+                    self.say("Sorry, but that is not a splittable hand!")
+            elif action == "surrender":
+                if surrender_allowed(len(hand), len(self.hands[self.activeUser]) > 1):
+                    self.say("{} surrenders and gets half their bet back.".format(self.activeUser.name))
+                    hand.bet = -(hand.bet // 2)
+                    turnover = True
+                elif len(hand) == 2:
+                    self.say("Sorry, but you can't surrender a split hand.")
+                else:
+                    self.say("Sorry, but you can only surrender your initial hand.")
+        self.turnaction = None
+        self.plan = None
+
+    async def player_action(self):
+        """Wait for the active player's next action ("hit", "stand", ...), or
+           take the next step of their plan, and journal it.  Returns None if
+           they timed out."""
+        if self.script is not None:
+            if not self.script:
+                raise ValueError("Journal ran out of actions")
+            player, code = self.script.popleft()
+            if player != self.round.index[self.activeUser.id]:
+                raise ValueError("Journal has another player acting")
+            action = JOURNAL_ACTIONS[code] if code else None
+        else:
+            if not self.plan:
+                await self.wait_until(lambda: self.stop or self.turnaction is not None or self.plan, self.settings["ACTIVE_DELAY"])
+            action = self.turnaction
+            self.turnaction = None
+            if action is None and self.plan:
+                action = self.planned_action()
+        if self.round is not None:
+            self.round.action(self.activeUser, action or "timeout", self.manager.bot.loop.time())
+            self.manager.wagers.action(self.wagerid, self.round.index[self.activeUser.id], action or "timeout")
+        return action
+
     async def do_hit(self, splitindex):
-        """Hit function for players"""
-        self.shoe.move_cards(self.hands[self.activeUser][splitindex], 1)
-        await bj_manager.bot.say(self.hands[self.activeUser][splitindex])
-        self.timer = int(time.perf_counter())
+        """Hit function for players.  Returns True if the hand is finished."""
+        hand = self.hands[self.activeUser][splitindex]
+        self.shoe.move_cards(hand, 1)
+        self.flush(PRIORITY_PROMPT) #so the render is a message of its own, which a newer render of the hand can replace
+        self.say(hand)
+        self.flush(PRIORITY_PROMPT, key=("render", self.activeUser.id, splitindex))
         self.status = "dealing"
-        if self.hands[self.activeUser][splitindex].bjhighval > 21:
-            await bj_manager.bot.say("{0} busted with {1}".format(self.activeUser.name, str(self.hands[self.activeUser][splitindex].bjhighval)))
-            self.hands[self.activeUser][splitindex].bet *= -1
-            self.timer -= self.settings["ACTIVE_DELAY"]
-        elif self.hands[self.activeUser][splitindex].bjhighval == 21:
-            self.status = "standing"
-
-    async def do_split(self, splitindex):
-        """Split function for players"""
-        self.splitcount += 1
+        if hand.bjhighval > 21:
+            self.say("{0} busted with {1}".format(self.activeUser.name, str(hand.bjhighval)))
+            hand.bet *= -1
+            return True
+        elif hand.bjhighval == 21:
+            self.turnaction = "stand"
+        elif self.showhints and self.hint(hand):
+            self.say("(Basic strategy: {})".format(self.hint(hand)))
+        return False
+
+    def strategy_code(self, hand):
+        """Basic strategy's action code for hand, or None without strategy tables"""
+        try:
+            return basic_strategy(hand, CARD_VALUES[self.dealerhand.cards[1]], self.shoe.decks, len(self.hands[hand.owner]) > 1)
+        except (OSError, ValueError):
+            return None
+
+    def hint(self, hand):
+        """Basic strategy advice for hand, or None without strategy tables"""
+        code = self.strategy_code(hand)
+        return None if code is None else HINT_WORDS[code]
+
+    def planned_action(self):
+        """Take the next step of the active player's plan.  A "hit until"
+           step hits until the hand reaches its total, then stands."""
+        step = self.plan[0]
+        if isinstance(step, int) and self.activehand.bjhighval < step:
+            return "hit"
+        self.plan.popleft()
+        return "stand" if isinstance(step, int) else step
+
+    def do_split(self, splitindex):
+        """Split function for players.  The new hand is played next, then
+           the one it was split from."""
         self.status = "dealing"
-        h1 = Hand(self.activeUser, False, self.hands[self.activeUser][splitindex].bet)
-        h2 = Hand(self.activeUser, False, self.hands[self.activeUser][splitindex].bet)
-        self.hands[self.activeUser][splitindex].move_cards(h1, 1)
-        self.hands[self.activeUser][splitindex].move_cards(h2, 1)
+        hands = self.hands[self.activeUser]
+        h1 = Hand(self.activeUser, False, hands[splitindex].bet)
+        h2 = Hand(self.activeUser, False, hands[splitindex].bet)
+        hands[splitindex].move_cards(h1, 1)
+        hands[splitindex].move_cards(h2, 1)
         self.shoe.move_cards(h1, 1)
         self.shoe.move_cards(h2, 1)
-        self.hands[self.activeUser][splitindex] = h1
-        self.hands[self.activeUser].append(h2)
-        await bj_manager.bot.say(self.dealerhand)
-        await bj_manager.bot.say(self.hands[self.activeUser][self.splitcount])
-        await self.active_dealer(self.splitcount)
-        await bj_manager.bot.say(self.dealerhand)
-        await bj_manager.bot.say(self.hands[self.activeUser][splitindex])
-        await self.active_dealer(splitindex)
-
-    async def finish_deal(self):
+        hands[splitindex] = h1
+        hands.append(h2)
+        self.turns.extendleft([(self.activeUser, splitindex, True), (self.activeUser, len(hands) - 1, True)])
+
+    async def finish_deal(self, revealed=False):
         """Finalize the dealer's hand actions"""
         self.status = "finishing"
-        await bj_manager.bot.say("Revealing Dealer's hand:")
-        self.dealerhand.isDealer = False
-        await bj_manager.bot.say(self.dealerhand)
+        if not revealed:
+            self.say("Revealing Dealer's hand:")
+            self.dealerhand.reveal()
+            self.say(self.dealerhand)
         activehands = 0
         for player in self.hands:
             for hand in self.hands[player]:
@@ -414,35 +909,33 @@ class BlackjackSession():
                     activehands += 1
         activehands -= len(self.blackjacks)
         if activehands >= 1:
-            suspensetimer = int(time.perf_counter())
-            while self.dealerhand.bjhighval < 21 and abs(suspensetimer - int(time.perf_counter())) <= 20:
-                await asyncio.sleep(2) #Waiting for suspense!
-                if self.dealerhand.bjhighval >= 17 and self.dealerhand.bjhighval <= 21:
-                    await bj_manager.bot.say("Dealer stands at " + str(self.dealerhand.bjhighval))
-                    suspensetimer -= 20
-                if self.dealerhand.bjhighval < 17:
-                    await bj_manager.bot.say("Dealer hits.")
-                    self.shoe.move_cards(self.dealerhand, 1)
-                    await bj_manager.bot.say(self.dealerhand)
+            if not self.turbo():
+                await self.wait_until(lambda: self.stop, 2) #Waiting for suspense!
+            while self.dealerhand.bjhighval < 17:
+                self.say("Dealer hits.")
+                self.shoe.move_cards(self.dealerhand, 1)
+                self.say(self.dealerhand)
+            if self.dealerhand.bjhighval <= 21:
+                self.say("Dealer stands at " + str(self.dealerhand.bjhighval))
             if self.dealerhand.bjhighval > 21:
-                await bj_manager.bot.say("Dealer busts with " + str(self.dealerhand.bjhighval) + ".  Everyone's a winner!  Unless you busted already, sucker.")
+                self.say("Dealer busts with " + str(self.dealerhand.bjhighval) + ".  Everyone's a winner!  Unless you busted already, sucker.")
             else:
                 for player in self.hands: #check who won!
                     for hand in self.hands[player]:  
                         if hand.bet > 0:
                             if self.dealerhand.bjhighval > hand.bjhighval:
-                                await bj_manager.bot.say("Sorry, {0}, but you lost with {1}!".format(player.mention, str(hand.bjhighval)))
+                                self.say("Sorry, {0}, but you lost with {1}!".format(player.mention, str(hand.bjhighval)))
                                 hand.bet *= -1
                             if hand.bjhighval > self.dealerhand.bjhighval:
-                                await bj_manager.bot.say("Congrats, {0}, you win with {1}!".format(player.mention, str(hand.bjhighval)))
+                                self.say("Congrats, {0}, you win with {1}!".format(player.mention, str(hand.bjhighval)))
                             if self.dealerhand.bjhighval == hand.bjhighval:
-                                await bj_manager.bot.say("Push at {1}, take back your bet, {0}".format(player.mention, str(hand.bjhighval)))
+                                self.say("Push at {1}, take back your bet, {0}".format(player.mention, str(hand.bjhighval)))
                                 hand.bet = 0
         else:
             if len(self.blackjacks) == 0:
-                await bj_manager.bot.say("Sorry table, looks like the house won this round!")
+                self.say("Sorry table, looks like the house won this round!")
             else:
-                await bj_manager.bot.say("Nice blackjack(s)!")
+                self.say("Nice blackjack(s)!")
         
         await self.analyze_bets()
 
@@ -450,79 +943,131 @@ class BlackjackSession():
         """Reset globals and start fresh!"""
         self.count += 1 #hands played per session
         self.activeUser = None
+        self.activehand = None
         self.hands = {}
         for player in self.bets:
             self.lastbets[player] = self.bets[player]
         self.bets = {}
         self.blackjacks = []
-        self.timer = int(time.perf_counter())
-        self.bettimer = None
+        self.wagerid = None
         self.status = "awaiting bets"
-        self.dealerReady = True
-        self.betReady = False
-        if self.stop: await self.stop_bj()
 
     async def init_deal(self):
         """Deal the table some cards.
         """
-        self.shoe = Shoe(self.settings["DECKS"])
-        self.shoe.shuffle()
-        await bj_manager.bot.say("Shuffling and dealing...")
+        self.status = "dealing"
+        start = time.perf_counter()
+        if self.shoe is None or self.shoe.cut_reached() or self.shoe.decks != self.settings["DECKS"]:
+            self.shoe = await self.next_shoe()
+            self.say("Shuffling and dealing...")
+        else:
+            self.say("Dealing...")
+        self.shoe.new_round()
+        self.round = RoundRecord(self.manager.bot.loop.time(), self.shoe,
+                                 [(player, bet, self.manager.bank.get_balance(player)) for player, bet in self.bets.items()])
+        self.manager.wagers.deal(self.wagerid, self.channel, self.round)
         for player in self.bets:
             playerhand = Hand(player, False, self.bets[player])
             self.shoe.move_cards(playerhand, 2)
             self.hands[player] = [playerhand]
-        self.dealerhand = Hand(bj_manager.bot.user, True, 0)
+        self.dealerhand = Hand(self.manager.bot.user, True, 0)
         self.shoe.move_cards(self.dealerhand, 2)
-        await bj_manager.bot.say(self.dealerhand)
+        self.say(self.dealerhand)
         for player in self.hands:
-            await bj_manager.bot.say(self.hands[player][0])
+            self.say(self.hands[player][0])
+        metrics.since("deal", start)
         #check for dealer BJ ... offer insurance here eventually?
         if self.dealerhand.isBlackjack:
             self.dbjcount += 1
-            await bj_manager.bot.say("Dealer Blackjack!!!")
-            self.dealerhand.isDealer = False
-            await bj_manager.bot.say(self.dealerhand)
+            self.say("Dealer Blackjack!!!")
+            self.dealerhand.reveal()
+            self.say(self.dealerhand)
             for player in self.hands:
                 if self.hands[player][0].isBlackjack:
                     self.hands[player][0].bet = 0
-                    await bj_manager.bot.say("Push for {}".format(player.mention))
+                    self.say("Push for {}".format(player.mention))
                 else: 
-                    await bj_manager.bot.say("Sorry {}.  You lose".format(player.mention))
+                    self.say("Sorry {}.  You lose".format(player.mention))
                     self.hands[player][0].bet *= -1
             await self.analyze_bets()
         else:
-            self.status = "dealing"
-            firstPlayer = True
-            for player in self.hands.keys():
-                if not firstPlayer:
-                    await bj_manager.bot.say(self.dealerhand)
-                    await bj_manager.bot.say(self.hands[player][0])
-                firstPlayer = False
-                self.activeUser = player
-                self.splitcount = 0
-                await self.active_dealer(0)
-            self.activeUser = bj_manager.bot.user
-            await self.finish_deal()
+            self.turns = deque((player, 0, i > 0) for i, player in enumerate(self.hands)) #the first hand was just shown
+            await self.play_turns()
+
+    async def play_turns(self):
+        """Play every queued turn, then the dealer's hand"""
+        while self.turns:
+            player, index, show = self.turn = self.turns.popleft()
+            self.activeUser = player
+            if show:
+                self.say(self.dealerhand)
+                self.say(self.hands[player][index])
+            await self.active_dealer(index)
+        self.turn = None
+        self.activeUser = self.manager.bot.user
+        await self.finish_deal()
+
+    def prepare_shoe(self):
+        """Start shuffling the next shoe in the executor, off the event loop"""
+        self.nextshoe = self.manager.bot.loop.run_in_executor(None, shuffled_shoe, self.settings["DECKS"],
+                                                              self.settings["PENETRATION"], self.rng.getrandbits(64))
+
+    async def next_shoe(self):
+        """Take the prepared shoe and start preparing the one after it"""
+        if self.nextshoe is None:
+            self.prepare_shoe()
+        shoe = await self.nextshoe
+        if shoe.decks != self.settings["DECKS"] or shoe.penetration != self.settings["PENETRATION"]:
+            shoe = shuffled_shoe(self.settings["DECKS"], self.settings["PENETRATION"], self.rng.getrandbits(64)) #settings changed meanwhile
+        self.prepare_shoe()
+        return shoe
 
     async def analyze_bets(self):
-        """Finalize bets and adjust the blackjack bank!"""
+        """Settle the round in one batched bank update and one balance line"""
+        start = time.perf_counter()
+        nets = {}
         for player in self.hands:
-            for hand in self.hands[player]: 
-                if hand.bet > 0:
-                    bj_manager.bank.deposit_credits(player, hand.bet)
-                elif hand.bet < 0:
-                    bj_manager.bank.withdraw_credits(player, hand.bet * -1)
-                await bj_manager.bot.say("{0}, your new balance is: {1}".format(player.mention, str(bj_manager.bank.get_balance(player))))
+            nets[player] = sum(hand.bet for hand in self.hands[player])
+        if nets:
+            bankstart = time.perf_counter()
+            balances, overdrawn = settlement(self.manager.bank, nets)
+            self.manager.wagers.settle(self.wagerid, [(player, balance - int(nets[player]), balance)
+                                                      for player, balance in balances.items()])
+            write_balances(self.manager.bank, balances)
+            metrics.since("bank", bankstart)
+            self.manager.playerstats.record(self.round_results(nets))
+            if self.journal is not None and self.round is not None:
+                self.journal.write(self.round.pack(nets))
+            if balances:
+                self.say("New balances: " + ", ".join(["{0} {1}".format(player.mention, str(balances[player])) for player in balances]))
+            for player, net in overdrawn.items():
+                balance = self.manager.bank.get_balance(player)
+                logger.info("Blackjack left player {}'s loss of {} unsettled in {}; their balance is {}".format(
+                            player.id, str(-net), str(self.channel), str(balance)))
+                self.say("{} can't cover a loss of {} with {} credits, so none of it was taken.  A moderator will sort it out.".format(
+                         player.mention, str(-net), str(balance)))
+        self.manager.wagers.close(self.wagerid)
+        metrics.since("settle", start)
         await self.reset_dealer()
 
+    def round_results(self, nets):
+        """One stats row per player for the round just settled"""
+        results = []
+        now = int(time.time())
+        for player, net in nets.items():
+            hands = self.hands[player]
+            results.append((player.server.id, player.id, player.name, self.channel.id, now, len(hands),
+                            sum(1 for hand in hands if hand.bet > 0), sum(1 for hand in hands if hand.bet < 0),
+                            sum(1 for hand in hands if hand.bet == 0), self.blackjacks.count(player), int(net)))
+        return results
+
     async def stop_bj(self):
         biggestwinner = "None"
         biggestloser = "None"
         biggestwinnings = 0
         biggestlosses = 0
         for player in self.startbal:
-            balance = bj_manager.bank.get_balance(player)
+            balance = self.manager.bank.get_balance(player)
             diff = balance - self.startbal[player]
             if diff > 0 and diff > biggestwinnings:
                 biggestwinner = player.name
@@ -537,29 +1082,1607 @@ class BlackjackSession():
             output = output + "\nBiggest Winner: " + biggestwinner + " won " + str(biggestwinnings)
         if biggestloser != "None":
             output = output + "\nBiggest Loser: " + biggestloser + " lost " + str(biggestlosses)
-        await bj_manager.bot.change_status(None)
-        await bj_manager.bot.say(output)
-        bj_manager.bj_sessions.remove(self)
+        if self.wagerid is not None: #bets placed, never dealt
+            self.manager.wagers.close(self.wagerid)
+            self.wagerid = None
+        await self.manager.bot.change_status(None)
+        metrics.count("api calls")
+        self.say(output)
+        self.flush(PRIORITY_STATS)
+        if self.manager.bj_sessions.get(self.channel.id) is self:
+            del self.manager.bj_sessions[self.channel.id]
+
+    async def abandon(self):
+        """Close a table whose task failed.  Bets only come out of the bank
+           when a round settles, so voiding the open round returns them."""
+        if self.wagerid is not None:
+            self.manager.wagers.close(self.wagerid)
+            self.wagerid = None
+        self.stop = True
+        self.active = False
+        self.output = []
+        self.say("Sorry, something went wrong and the table has closed.  Bets on the unfinished round were returned.")
+        self.flush(PRIORITY_PROMPT)
+        if self.manager.bj_sessions.get(self.channel.id) is self:
+            del self.manager.bj_sessions[self.channel.id]
+        try:
+            await self.manager.bot.change_status(None)
+            metrics.count("api calls")
+        except discord.HTTPException as e:
+            logger.info("Blackjack status reset failed: {}".format(str(e)))
+
+    def hand_off(self):
+        """The table as plain data for restore_session, taken while its
+           dealer task is paused.  Cards are bytes and players the same
+           Member objects, so nothing from this module outlives a reload.
+           A turn in progress is played again from its prompt."""
+        now = self.manager.bot.loop.time()
+        state = {name: getattr(self, name) for name in HANDOFF_FIELDS}
+        state["channel"] = self.channel
+        state["seed"] = self.seed
+        state["rng"] = self.rng.getstate()
+        state["seats"] = self.seats.size
+        state["players"] = sorted(self.seats.players.items())
+        state["hands"] = [(player, [(bytes(hand.cards), hand.bet) for hand in hands]) for player, hands in self.hands.items()]
+        state["dealerhand"] = None if self.dealerhand is None else (bytes(self.dealerhand.cards), self.dealerhand.isDealer)
+        turns = list(self.turns)
+        if self.turn is not None:
+            turns.insert(0, (self.turn[0], self.turn[1], True))
+        state["turns"] = turns
+        shoe = self.shoe
+        state["shoe"] = None if shoe is None else (bytes(shoe.cards), shoe.decks, shoe.penetration, shoe.cutcard, shoe.seed,
+                                                   shoe.rng.getstate(), shoe.dealt, bytes(shoe.inplay))
+        state["round"] = None if self.round is None else {name: getattr(self.round, name) for name in RoundRecord.__slots__}
+        state["journal"] = None if self.journal is None else self.journal.hand_off()
+        state["inbox"] = []
+        while not self.inbox.empty():
+            state["inbox"].append(tuple(self.inbox.get_nowait()))
+        state["wait"] = None if self.deadline is None else max(0.0, self.deadline - now)
+        return state
+
+
+#data/blackjack/settings.json holds the defaults new servers start from;
+#each server that changes anything gets its own file here.
+SERVER_SETTINGS_DIR = "data/blackjack/servers"
+DEFAULT_SETTINGS = {"ACTIVE_TIMEOUT" : 45, "MIN_BET" : 10, "MAX_BET" : 1000, "DECKS" : 1, "ACTIVE_DELAY" : 20, "BET_TIMEOUT" : 10, "PENETRATION" : 75, "SEATS" : 6, "TURBO" : []} #TURBO: channel ids
+SETTINGS_LIMITS = {"ACTIVE_TIMEOUT" : (31, None), "MIN_BET" : (1, None), "MAX_BET" : (100, None), "DECKS" : (1, 8),
+                   "ACTIVE_DELAY" : (10, None), "BET_TIMEOUT" : (5, None), "PENETRATION" : (50, 90), "SEATS" : (1, 24)}
+SEATS_PER_DECK = 7 #a full table's round fits in the shoe without dealing cards still on the table
+
+class SettingsStore():
+    """Per server settings, cached in memory and written behind.
+
+    Every server's settings are loaded when the cog loads, and the same dict
+    is handed to every table on that server, so changes apply live.  set()
+    only marks the server dirty; a debounced save serializes it on the loop
+    and writes it from the executor to a temp file that then replaces the
+    server's file, so disk I/O never blocks the event loop and a crash
+    never leaves a half written file.  Writes take turns, and each carries
+    a version so an older one never lands on top of a newer one."""
+
+    def __init__(self, loop, delay=2.0):
+        self.loop = loop
+        self.delay = delay
+        self.defaults = validate_settings(fileIO("data/blackjack/settings.json", "load"), DEFAULT_SETTINGS)
+        self.servers = {} #[server id]settings
+        self.pending = {} #[server id]TimerHandle of the scheduled save
+        self.writing = {} #[server id]future of the write in flight
+        self.version = 0 #of the newest save
+        self.saved = {} #[server id]version on disk
+        self.lock = threading.Lock() #held by the write in progress, from the executor or close()
+        for name in os.listdir(SERVER_SETTINGS_DIR):
+            serverid, ext = os.path.splitext(name)
+            if ext == ".json":
+                self.servers[serverid] = self.load(serverid)
+
+    def path(self, serverid):
+        return os.path.join(SERVER_SETTINGS_DIR, serverid + ".json")
+
+    def load(self, serverid):
+        settings = dict(self.defaults)
+        try:
+            settings.update(fileIO(self.path(serverid), "load"))
+        except ValueError:
+            logger.info("Blackjack settings for server {} are unreadable, using defaults".format(serverid))
+        return validate_settings(settings, self.defaults)
+
+    def get(self, server):
+        settings = self.servers.get(server.id)
+        if settings is None: #nothing saved for this server yet
+            settings = self.servers[server.id] = dict(self.defaults)
+        return settings
+
+    def set(self, server, key, value):
+        self.get(server)[key] = value
+        if server.id not in self.pending:
+            self.pending[server.id] = self.loop.call_later(self.delay, self.save, server.id)
+
+    def save(self, serverid):
+        writing = self.writing.get(serverid)
+        if writing is not None and not writing.done(): #keep writes to one file in order
+            self.pending[serverid] = self.loop.call_later(self.delay, self.save, serverid)
+            return
+        self.pending.pop(serverid, None)
+        self.version += 1
+        data = json.dumps(self.servers[serverid], indent=4, sort_keys=True)
+        self.writing[serverid] = self.loop.run_in_executor(None, self.write, serverid, self.version, data)
+
+    def write(self, serverid, version, data):
+        """Write one server's settings, unless a newer version got there first"""
+        with self.lock:
+            if version > self.saved.get(serverid, 0):
+                write_atomic(self.path(serverid), data)
+                self.saved[serverid] = version
+
+    def close(self):
+        """Write anything still waiting on its debounce, right now.  A write
+           already in the executor finishes first."""
+        for serverid, handle in list(self.pending.items()):
+            handle.cancel()
+            self.pending.pop(serverid)
+            self.version += 1
+            self.write(serverid, self.version, json.dumps(self.servers[serverid], indent=4, sort_keys=True))
+
+def validate_settings(settings, defaults):
+    """Drop unknown keys and replace values that are missing or out of range"""
+    valid = {}
+    for key, default in defaults.items():
+        value = settings.get(key, default)
+        low, high = SETTINGS_LIMITS.get(key, (None, None))
+        if not isinstance(value, type(default)) or (low is not None and value < low) or (high is not None and value > high):
+            value = default
+        valid[key] = value
+    if valid["MAX_BET"] < valid["MIN_BET"]:
+        valid["MAX_BET"] = max(valid["MIN_BET"], defaults["MAX_BET"])
+    return valid
+
+def write_atomic(path, data):
+    """Write data to path through a temp file, so readers never see half of
+       it.  Each write gets a temp file of its own."""
+    fd, temp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with (os.fdopen(fd, "wb") if isinstance(data, bytes) else os.fdopen(fd, "w", encoding="utf-8")) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+STATS_FILE = "data/blackjack/stats.db"
+STATS_RANKINGS = ["net", "wins", "hands", "blackjacks"]
+STATS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rounds (server TEXT, user TEXT, channel TEXT, time INTEGER, hands INTEGER,
+    wins INTEGER, losses INTEGER, pushes INTEGER, blackjacks INTEGER, net INTEGER);
+CREATE TABLE IF NOT EXISTS players (server TEXT, user TEXT, name TEXT, rounds INTEGER DEFAULT 0,
+    hands INTEGER DEFAULT 0, wins INTEGER DEFAULT 0, losses INTEGER DEFAULT 0, pushes INTEGER DEFAULT 0,
+    blackjacks INTEGER DEFAULT 0, net INTEGER DEFAULT 0, PRIMARY KEY (server, user));
+CREATE INDEX IF NOT EXISTS players_net ON players (server, net);
+CREATE INDEX IF NOT EXISTS players_wins ON players (server, wins);
+CREATE INDEX IF NOT EXISTS players_hands ON players (server, hands);
+CREATE INDEX IF NOT EXISTS players_blackjacks ON players (server, blackjacks);
+CREATE INDEX IF NOT EXISTS players_all_net ON players (net);
+CREATE INDEX IF NOT EXISTS players_all_wins ON players (wins);
+CREATE INDEX IF NOT EXISTS players_all_hands ON players (hands);
+CREATE INDEX IF NOT EXISTS players_all_blackjacks ON players (blackjacks);
+"""
+LEADERBOARD_SIZE = 25 #players each leaderboard keeps in memory; a query can ask for up to this many
+
+class StatsStore():
+    """Player statistics in SQLite.
+
+    Every settled round is appended to the rounds log and folded into the
+    per player totals in the same transaction, so leaderboards and stats
+    are indexed reads of the totals and never scan the history.  One
+    worker thread owns the connection; nothing here blocks the event loop.
+
+    Leaderboards are loaded from the index the first time they're asked
+    for, then kept up to date in memory from the totals each write hands
+    back, so most queries never reach the database.  Writes and loads run
+    in order on the one thread, so every update lands after the load it
+    belongs to."""
+
+    def __init__(self, loop, path=STATS_FILE):
+        self.loop = loop
+        self.path = path
+        self.db = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.boards = {} #[(server id, or None for every server, stat)]Leaderboard
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path)
+            self.db.executescript(STATS_SCHEMA)
+        return self.db
+
+    def close(self):
+        self.executor.submit(self._close)
+        self.executor.shutdown(wait=False)
+
+    def _close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def record(self, results):
+        """Queue one round's (server, user, name, channel, time, hands, wins,
+           losses, pushes, blackjacks, net) rows"""
+        future = self.loop.run_in_executor(self.executor, self._record, results)
+        future.add_done_callback(self.recorded)
+
+    def recorded(self, future):
+        """Fold the players' new totals into the leaderboards that are loaded"""
+        if future.exception() is not None:
+            logger.info("Blackjack stats write failed: " + str(future.exception()))
+            return
+        for server, user, name, *totals in future.result():
+            for stat, value in zip(STATS_RANKINGS, totals):
+                board = self.boards.get((server, stat))
+                if board is not None:
+                    board.update(user, value, name)
+                board = self.boards.get((None, stat))
+                if board is not None:
+                    board.update((server, user), value, name)
+
+    def _record(self, results):
+        db = self.connect()
+        with db:
+            db.executemany("INSERT INTO rounds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           [(server, user, channel, now, hands, wins, losses, pushes, blackjacks, net)
+                            for server, user, name, channel, now, hands, wins, losses, pushes, blackjacks, net in results])
+            db.executemany("INSERT OR IGNORE INTO players (server, user, name) VALUES (?, ?, ?)",
+                           [(result[0], result[1], result[2]) for result in results])
+            db.executemany("UPDATE players SET name = ?, rounds = rounds + 1, hands = hands + ?, wins = wins + ?, "
+                           "losses = losses + ?, pushes = pushes + ?, blackjacks = blackjacks + ?, net = net + ? "
+                           "WHERE server = ? AND user = ?",
+                           [(name, hands, wins, losses, pushes, blackjacks, net, server, user)
+                            for server, user, name, channel, now, hands, wins, losses, pushes, blackjacks, net in results])
+        query = "SELECT server, user, name, {} FROM players WHERE server = ? AND user = ?".format(", ".join(STATS_RANKINGS))
+        return [db.execute(query, (result[0], result[1])).fetchone() for result in results]
+
+    async def leaderboard(self, server, stat, count=10):
+        """Top count (key, value, name) for stat, which must be in
+           STATS_RANKINGS, on server or, if it's None, on every server.
+           Keys are user ids, or (server id, user id) across servers."""
+        board = self.boards.get((server, stat))
+        if board is None or len(board) < count and not board.exact:
+            rows = await self.loop.run_in_executor(self.executor, self._leaderboard, server, stat)
+            board = Leaderboard(rows, len(rows) < LEADERBOARD_SIZE)
+            self.boards[(server, stat)] = board
+        return board.top(count)
+
+    def _leaderboard(self, server, stat):
+        if server is None:
+            query = "SELECT server, user, {0}, name FROM players ORDER BY {0} DESC LIMIT ?".format(stat)
+            rows = self.connect().execute(query, (LEADERBOARD_SIZE,)).fetchall()
+            return [((server, user), value, name) for server, user, value, name in rows]
+        query = "SELECT user, {0}, name FROM players WHERE server = ? ORDER BY {0} DESC LIMIT ?".format(stat)
+        return self.connect().execute(query, (server, LEADERBOARD_SIZE)).fetchall()
+
+    async def player(self, server, user):
+        return await self.loop.run_in_executor(self.executor, self._player, server, user)
+
+    def _player(self, server, user):
+        return self.connect().execute("SELECT rounds, hands, wins, losses, pushes, blackjacks, net FROM players "
+                                      "WHERE server = ? AND user = ?", (server, user)).fetchone()
+
+
+class Leaderboard():
+    """The top players for one stat, highest first.
+
+    It holds exactly the top n players for some n up to LEADERBOARD_SIZE,
+    and everyone else is at or below the last of them.  order is sorted by
+    bisect, so a settled round moves a player in O(LEADERBOARD_SIZE) and a
+    query is a slice.  A member whose total drops below the bottom of the
+    board leaves it, since someone outside could now be ahead, and the
+    board gets shorter; StatsStore reloads it once it's too short for a
+    query.  exact is set while the board holds every player there is."""
+    __slots__ = ("order", "values", "exact")
+
+    def __init__(self, rows, exact):
+        self.order = sorted((-value, key) for key, value, name in rows) #(-value, key)
+        self.values = {key: (value, name) for key, value, name in rows} #[key](value, name)
+        self.exact = exact
+
+    def __len__(self):
+        return len(self.order)
+
+    def update(self, key, value, name):
+        bottom = -self.order[-1][0] if self.order else None
+        old = self.values.pop(key, None)
+        if old is not None:
+            del self.order[bisect.bisect_left(self.order, (-old[0], key))]
+        if self.exact or (bottom is not None and value >= bottom):
+            bisect.insort(self.order, (-value, key))
+            self.values[key] = (value, name)
+            if len(self.order) > LEADERBOARD_SIZE:
+                del self.values[self.order.pop()[1]]
+                self.exact = False
+
+    def top(self, count):
+        return [(key,) + self.values[key] for value, key in self.order[:count]]
+
+
+#Every round a table plays is journaled compactly enough to keep: the
+#seed of the shoe it was dealt from, each player's bet and balance, and
+#each action with its time.  A replay deals the same cards and plays the
+#same actions through BlackjackSession, at full speed.
+JOURNAL_DIR = "data/blackjack/journals"
+JOURNAL_MAGIC = b"BJR1"
+JOURNAL_ACTIONS = ("timeout", "hit", "stand", "double", "split", "surrender") #indexed by action code
+JOURNAL_CODES = {action: code for code, action in enumerate(JOURNAL_ACTIONS)}
+JOURNAL_HEADER = struct.Struct("<4sQQ") #magic, channel id, table seed
+JOURNAL_ROUND = struct.Struct("<IdQIBBBH") #record length, time, shoe seed, cards dealt before, decks, penetration, players, actions
+JOURNAL_PLAYER = struct.Struct("<Qqqq") #player id, bet, balance before, net result
+JOURNAL_ACTION = struct.Struct("<IBB") #milliseconds into the round, player, action code
+
+class RoundRecord():
+    """One round, as the journal stores it"""
+    __slots__ = ("start", "time", "seed", "dealt", "decks", "penetration", "players", "index", "actions")
+
+    def __init__(self, start, shoe, players):
+        self.start = start #loop time of the deal
+        self.time = time.time()
+        self.seed = shoe.seed or 0
+        self.dealt = shoe.dealt
+        self.decks = shoe.decks
+        self.penetration = shoe.penetration
+        self.players = players #[(player, bet, balance)] in dealing order
+        self.index = {player.id: i for i, (player, bet, balance) in enumerate(players)}
+        self.actions = bytearray()
+
+    def action(self, player, action, now):
+        self.actions += JOURNAL_ACTION.pack(int((now - self.start) * 1000), self.index[player.id], JOURNAL_CODES[action])
+
+    def pack(self, nets):
+        body = b"".join([JOURNAL_PLAYER.pack(int(player.id), bet, balance, int(nets.get(player, 0)))
+                         for player, bet, balance in self.players])
+        return JOURNAL_ROUND.pack(JOURNAL_ROUND.size + len(body) + len(self.actions), self.time, self.seed, self.dealt,
+                                  self.decks, self.penetration, len(self.players), len(self.actions) // JOURNAL_ACTION.size
+                                  ) + body + bytes(self.actions)
+
+
+class RoundJournal():
+    """Appends one table's rounds to its own file in JOURNAL_DIR.  Writes
+    run in the executor, one at a time so records stay in order, and the
+    file isn't created until the first round is played."""
+
+    def __init__(self, loop, channelid, seed, path=None):
+        self.loop = loop
+        if path is None:
+            self.path = os.path.join(JOURNAL_DIR, "{}-{}.bjr".format(channelid, str(int(time.time()))))
+            self.buffer = bytearray(JOURNAL_HEADER.pack(JOURNAL_MAGIC, int(channelid), seed))
+        else: #carrying on with a file a handed-off table started
+            self.path = path
+            self.buffer = bytearray()
+        self.writing = None
+
+    def write(self, record):
+        self.buffer += record
+        if self.writing is None:
+            self.flush()
+
+    def flush(self):
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        self.writing = self.loop.run_in_executor(None, append_file, self.path, data)
+        self.writing.add_done_callback(self.written)
+
+    def written(self, future):
+        self.writing = None
+        if future.exception() is not None:
+            logger.info("Blackjack journal write to {} failed: {}".format(self.path, str(future.exception())))
+        if self.buffer:
+            self.flush()
+
+    def hand_off(self):
+        """(path, unwritten bytes, write in flight) for take_over.  The
+           bytes are taken so this journal won't write them too."""
+        buffer = bytes(self.buffer)
+        self.buffer = bytearray()
+        return self.path, buffer, self.writing
+
+    def take_over(self, buffer, writing):
+        """Write on after the journal this one replaces, in order"""
+        self.buffer += buffer
+        if writing is not None and not writing.done():
+            self.writing = writing
+            writing.add_done_callback(self.written)
+        elif self.buffer:
+            self.flush()
+
+def append_file(path, data):
+    with open(path, "ab") as f:
+        f.write(data)
+
+def read_journal(path):
+    """Returns (channel id, table seed, rounds) from a journal file.  Each
+    round is a dict of the JOURNAL_ROUND fields plus players, a list of
+    (id, bet, balance, net), and actions, a list of (ms, player, code).
+    A record cut short by a crash ends the list."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < JOURNAL_HEADER.size:
+        raise ValueError("Journal is too short")
+    magic, channelid, seed = JOURNAL_HEADER.unpack_from(data)
+    if magic != JOURNAL_MAGIC:
+        raise ValueError("Not a blackjack journal")
+    rounds = []
+    offset = JOURNAL_HEADER.size
+    while offset + JOURNAL_ROUND.size <= len(data):
+        length, start, shoeseed, dealt, decks, penetration, players, actions = JOURNAL_ROUND.unpack_from(data, offset)
+        if offset + length > len(data):
+            break
+        pos = offset + JOURNAL_ROUND.size
+        bets = [JOURNAL_PLAYER.unpack_from(data, pos + i * JOURNAL_PLAYER.size) for i in range(players)]
+        pos += players * JOURNAL_PLAYER.size
+        rounds.append({"time": start, "seed": shoeseed, "dealt": dealt, "decks": decks, "penetration": penetration,
+                       "players": bets, "actions": [JOURNAL_ACTION.unpack_from(data, pos + i * JOURNAL_ACTION.size)
+                                                    for i in range(actions)]})
+        offset += length
+    return channelid, seed, rounds
+
+
+class ReplayUser():
+    def __init__(self, userid, name=None):
+        self.id = str(userid)
+        self.name = name or "player" + self.id
+        self.mention = "<@{}>".format(self.id)
+        self.server = REPLAY_SERVER
+
+
+class ReplayChannel():
+    def __init__(self, channelid):
+        self.id = str(channelid)
+        self.name = "replay-" + self.id
+        self.server = REPLAY_SERVER
+
+    def __str__(self):
+        return self.name
+
+
+class ReplayMessage():
+    def __init__(self, channel):
+        self.channel = channel
+        self.server = channel.server
+
+
+class ReplayBot():
+    def __init__(self, loop):
+        self.loop = loop
+        self.user = ReplayUser(0, "Dealer")
+
+
+class ReplayBank():
+    """Balances as the journal recorded them at the start of each round"""
+
+    def __init__(self):
+        self.balances = {} #[player id]balance
+
+    def account_exists(self, player):
+        return True
+
+    def can_spend(self, player, amount):
+        return self.balances[player.id] >= amount
+
+    def get_balance(self, player):
+        return self.balances[player.id]
+
+    def set_credits(self, player, amount):
+        self.balances[player.id] = amount
+
+
+class ReplayTable():
+    """Headless stand-in for the cog, as much of it as a session uses.
+    It is its own outbox, collecting what the table says, and its own
+    stats store, which keeps nothing."""
+
+    def __init__(self, loop):
+        self.bot = ReplayBot(loop)
+        self.bank = ReplayBank()
+        self.clock = TableClock(loop)
+        self.outbox = self
+        self.playerstats = self
+        self.wagers = WagerLog(loop, None)
+        self.bj_sessions = {}
+        self.linessaid = 0
+        self.messagessent = 0
+        self.output = []
+
+    def send(self, channel, content, priority=None, key=None, stamp=None):
+        self.output.append(content)
+
+    def record(self, results):
+        pass
+
+REPLAY_SERVER = discord.Object(id="0")
+
+async def replay_round(journaled, table, channel, partial=False):
+    """Play one journaled round again through BlackjackSession.
+       partial rounds were cut short; hands past their last action are void.
+       Returns each player's (journaled net, replayed net)."""
+    settings = dict(DEFAULT_SETTINGS, DECKS=journaled["decks"], PENETRATION=journaled["penetration"])
+    session = BlackjackSession(ReplayMessage(channel), settings, manager=table)
+    session.shoe = shuffled_shoe(journaled["decks"], journaled["penetration"], journaled["seed"])
+    for _ in range(journaled["dealt"]):
+        session.shoe.pop_card()
+    players = []
+    for playerid, bet, balance, net in journaled["players"]:
+        player = ReplayUser(playerid)
+        players.append(player)
+        table.bank.balances[player.id] = balance
+        session.bets[player] = bet
+    session.script = deque((player, code) for ms, player, code in journaled["actions"])
+    session.partial = partial
+    await session.init_deal()
+    session.flush()
+    if session.script:
+        raise ValueError("Journal has actions the replay never asked for")
+    return [(net, table.bank.balances[player.id] - balance)
+            for player, (playerid, bet, balance, net) in zip(players, journaled["players"])]
+
+async def replay_journal(path):
+    """Replay every round in a journal file.
+       Returns (rounds, rounds that settled differently, the replay table)."""
+    channelid, seed, rounds = read_journal(path)
+    table = ReplayTable(asyncio.get_event_loop())
+    channel = ReplayChannel(channelid)
+    differ = 0
+    for journaled in rounds:
+        results = await replay_round(journaled, table, channel)
+        if any(net != replayed for net, replayed in results):
+            differ += 1
+    return len(rounds), differ, table
+
+
+#Wager log: every bet, deal, action and settlement, appended as it happens
+#so recover_wagers can finish rounds a crash cut short.  Records are a
+#WAGER_HEAD then the body for their kind.
+WAGER_FILE = "data/blackjack/wagers.log"
+WAGER_COMPACT_SIZE = 1 << 20 #bytes the log may grow to before it's rewritten with only the open rounds
+WAGER_BET, WAGER_DEAL, WAGER_STAKE, WAGER_ACTION, WAGER_SETTLE, WAGER_DONE = range(6)
+WAGER_HEAD = struct.Struct("<BQ") #kind, round id
+WAGER_BODIES = (struct.Struct("<Qq"), #bet: player id, bet
+                struct.Struct("<QQQIBB"), #deal: channel id, server id, shoe seed, cards dealt before, decks, penetration
+                struct.Struct("<Qqq"), #stake, one per player after a deal: player id, bet, balance
+                struct.Struct("<BB"), #action: player, action code
+                struct.Struct("<Qqq"), #settle: player id, balance before, balance after
+                struct.Struct("")) #done
+
+class WagerLog():
+    """Append-only log of every table's wagers.
+
+    Records are packed into a buffer on the loop, which costs a bet next to
+    nothing, and written out by the executor one batch at a time, each
+    batch fsynced once.  A deal, double, split or settlement starts a batch
+    if none is being written; anything logged meanwhile goes in the next.  Once the
+    file passes WAGER_COMPACT_SIZE the next batch rewrites it with just the
+    records of rounds still open, which are kept in memory for that.
+    A path of None keeps nothing, for replays."""
+
+    def __init__(self, loop, path=WAGER_FILE):
+        self.loop = loop
+        self.path = path
+        self.nextid = int(time.time() * 1000) << 16 #ids stay unique across restarts
+        self.open = {} #[round id]bytearray of its records
+        self.buffer = bytearray()
+        self.writing = None
+        self.size = os.path.getsize(path) if path is not None and os.path.isfile(path) else 0
+        self.compacting = False
+
+    def open_round(self):
+        self.nextid += 1
+        self.open[self.nextid] = bytearray()
+        return self.nextid
+
+    def append(self, kind, roundid, *fields):
+        if self.path is None:
+            return
+        record = WAGER_HEAD.pack(kind, roundid) + WAGER_BODIES[kind].pack(*fields)
+        self.buffer += record
+        records = self.open.get(roundid)
+        if records is not None:
+            records += record
+
+    def bet(self, roundid, player, bet):
+        self.append(WAGER_BET, roundid, int(player.id), bet)
+
+    def deal(self, roundid, channel, record):
+        self.append(WAGER_DEAL, roundid, int(channel.id), int(channel.server.id), record.seed, record.dealt,
+                    record.decks, record.penetration)
+        for player, bet, balance in record.players:
+            self.append(WAGER_STAKE, roundid, int(player.id), bet, balance)
+        self.sync()
+
+    def action(self, roundid, player, action):
+        self.append(WAGER_ACTION, roundid, player, JOURNAL_CODES[action])
+        if action == "double" or action == "split": #these raise the stakes, so they don't wait for the round's end
+            self.sync()
+
+    def settle(self, roundid, balances):
+        for player, before, after in balances:
+            self.append(WAGER_SETTLE, roundid, int(player.id), before, after)
+
+    def close(self, roundid):
+        self.append(WAGER_DONE, roundid)
+        self.open.pop(roundid, None)
+        self.sync()
+
+    def keep(self, roundid, logged):
+        """Hold a round read back by read_wagers open, so its records
+           survive the log being compacted"""
+        records = bytearray()
+        for kind, entries in ((WAGER_DEAL, [logged["deal"]]), (WAGER_STAKE, logged["stakes"]),
+                              (WAGER_ACTION, logged["actions"]), (WAGER_SETTLE, logged["settles"])):
+            for fields in entries:
+                records += WAGER_HEAD.pack(kind, roundid) + WAGER_BODIES[kind].pack(*fields)
+        self.open[roundid] = records
+
+    def compact(self):
+        """Rewrite the log with only the open rounds on the next batch"""
+        self.compacting = True
+        self.sync()
+
+    def sync(self):
+        if self.writing is None and (self.buffer or self.compacting) and self.path is not None:
+            self.flush()
+
+    def flush(self):
+        if self.compacting or self.size > WAGER_COMPACT_SIZE:
+            data = b"".join(self.open.values())
+            job = write_atomic
+            self.size = len(data)
+            self.compacting = False
+        else:
+            data = bytes(self.buffer)
+            job = append_synced
+            self.size += len(data)
+        self.buffer = bytearray()
+        self.writing = self.loop.run_in_executor(None, job, self.path, data)
+        self.writing.add_done_callback(self.written)
+
+    def written(self, future):
+        self.writing = None
+        if future.exception() is not None:
+            logger.info("Blackjack wager log write failed: " + str(future.exception()))
+        self.sync()
+
+    def hand_off(self):
+        """State for the log of a reloaded cog.  A write in flight keeps the
+           buffer back for the new log to write after it; otherwise it goes now."""
+        if self.writing is None:
+            self.sync()
+            buffer = b""
+        else:
+            buffer = bytes(self.buffer)
+            self.buffer = bytearray()
+        return {"open": self.open, "nextid": self.nextid, "size": self.size, "buffer": buffer, "writing": self.writing}
+
+    def take_over(self, state):
+        self.open.update(state["open"])
+        self.nextid = max(self.nextid, state["nextid"])
+        self.size = state["size"]
+        self.buffer += state["buffer"]
+        writing = state["writing"]
+        if writing is not None and not writing.done():
+            self.writing = writing
+            writing.add_done_callback(self.written)
+        else:
+            self.sync()
+
+def append_synced(path, data):
+    with open(path, "ab") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def read_wagers(path):
+    """Every round in the wager log, by id, as a dict of its deal (or None),
+    stakes [(player id, bet, balance)], actions [(player, code)], settles
+    [(player id, before, after)] and whether it's done.  A record cut short
+    by a crash ends the log."""
+    rounds = {}
+    if not os.path.isfile(path):
+        return rounds
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + WAGER_HEAD.size <= len(data):
+        kind, roundid = WAGER_HEAD.unpack_from(data, offset)
+        if kind >= len(WAGER_BODIES):
+            break
+        body = WAGER_BODIES[kind]
+        if offset + WAGER_HEAD.size + body.size > len(data):
+            break
+        fields = body.unpack_from(data, offset + WAGER_HEAD.size)
+        offset += WAGER_HEAD.size + body.size
+        logged = rounds.setdefault(roundid, {"deal": None, "stakes": [], "actions": [], "settles": [], "done": False})
+        if kind == WAGER_DEAL:
+            logged["deal"] = fields
+        elif kind == WAGER_STAKE:
+            logged["stakes"].append(fields)
+        elif kind == WAGER_ACTION:
+            logged["actions"].append(fields)
+        elif kind == WAGER_SETTLE:
+            logged["settles"].append(fields)
+        elif kind == WAGER_DONE:
+            logged["done"] = True
+    return rounds
+
+
+#A reload hands each running table from the old module's cog to the new
+#one as plain data on the bot, picked up by setup() if it's recent enough.
+HANDOFF_ATTR = "blackjack_handoff"
+HANDOFF_TTL = 60 #seconds a handoff waits for the cog to load again; after that the tables are dropped
+HANDOFF_FIELDS = ("status", "betwindow", "wagerid", "count", "pbjcount", "dbjcount", "bets", "lastbets", "startbal", "blackjacks",
+                  "activeUser", "showhints", "output", "actionstamp", "dropped", "linessaid", "messagessent")
+
+def restore_session(state, manager):
+    """Rebuild a BlackjackSession from its hand_off() state, ready for
+       dealer_waiting(resume=True)"""
+    channel = state["channel"]
+    session = BlackjackSession(ReplayMessage(channel), manager.settings.get(channel.server), state["seed"], manager)
+    for name in HANDOFF_FIELDS:
+        setattr(session, name, state[name])
+    session.rng.setstate(state["rng"])
+    session.seats = SeatMap(state["seats"])
+    for seat, player in state["players"]:
+        session.seats.sit(player, seat)
+    for player, hands in state["hands"]:
+        session.hands[player] = [restore_hand(player, False, bet, cards) for cards, bet in hands]
+    if state["dealerhand"] is not None:
+        cards, hidden = state["dealerhand"]
+        session.dealerhand = restore_hand(manager.bot.user, hidden, 0, cards)
+    session.turns = deque(state["turns"])
+    if state["shoe"] is not None:
+        cards, decks, penetration, cutcard, seed, rngstate, dealt, inplay = state["shoe"]
+        session.shoe = Shoe(decks, penetration, seed)
+        session.shoe.cards = bytearray(cards)
+        session.shoe.cutcard = cutcard
+        session.shoe.rng.setstate(rngstate)
+        session.shoe.dealt = dealt
+        session.shoe.inplay = bytearray(inplay)
+    if state["round"] is not None:
+        session.round = RoundRecord.__new__(RoundRecord)
+        for name, value in state["round"].items():
+            setattr(session.round, name, value)
+    if state["journal"] is not None:
+        path, buffer, writing = state["journal"]
+        session.journal = RoundJournal(manager.bot.loop, channel.id, session.seed, path)
+        session.journal.take_over(buffer, writing)
+    for kind, player, amount in state["inbox"]:
+        session.inboxkeys.add((kind, player.id, amount))
+        session.inbox.put_nowait(TableAction(kind, player, amount))
+    session.resumewait = state["wait"]
+    session.active = True
+    return session
+
+
+class SeatMap():
+    """Who sits where at a table.
+
+    Free seats are the set bits of one integer, bit n-1 for seat n, so the
+    lowest open seat is a single bit trick, and a player id index answers
+    whether someone is seated without looking at the seats.  No method
+    awaits, so each sit, getup or move happens whole on the event loop and
+    no lock is needed."""
+    __slots__ = ("size", "free", "players", "byid")
+
+    def __init__(self, size=6):
+        self.size = size
+        self.free = (1 << size) - 1
+        self.players = {} #[seat]player
+        self.byid = {} #[player id]seat
 
-async def get_bj_by_channel(channel):
-        for b in bj_manager.bj_sessions:
-            if b.channel == channel:
-                return b
-        return False        
+    def __len__(self):
+        return len(self.byid)
+
+    def __contains__(self, player):
+        return player.id in self.byid
+
+    def seat_of(self, player):
+        return self.byid.get(player.id)
+
+    def sit(self, player, seat=None):
+        """Seat player at seat, or the lowest open seat if that one's taken.
+           Returns the seat, or None when the table is full."""
+        if player.id in self.byid:
+            return self.byid[player.id]
+        if seat is None or not self.free >> (seat - 1) & 1:
+            if not self.free:
+                return None
+            seat = (self.free & -self.free).bit_length()
+        self.free &= ~(1 << (seat - 1))
+        self.players[seat] = player
+        self.byid[player.id] = seat
+        return seat
+
+    def getup(self, player):
+        """Free player's seat.  Returns it, or None if player wasn't seated."""
+        seat = self.byid.pop(player.id, None)
+        if seat is not None:
+            del self.players[seat]
+            self.free |= 1 << (seat - 1)
+        return seat
+
+    def move(self, player, seat):
+        """Move a seated player to an open seat.  Returns whether they moved."""
+        current = self.byid.get(player.id)
+        if current is None or seat < 1 or seat > self.size or not self.free >> (seat - 1) & 1:
+            return False
+        self.getup(player)
+        self.sit(player, seat)
+        return True
+
+
+class TableClock():
+    """One heap of deadlines shared by every table.
+
+    Only the earliest deadline is armed on the event loop, so idle tables
+    cost nothing and a thousand waiting tables still mean one timer handle.
+    Cancelled entries are dropped lazily when they reach the top."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.heap = [] #[deadline, seq, callback]
+        self.handle = None
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, seconds, callback):
+        """Call callback() after seconds.  Returns an entry for cancel()"""
+        self.seq += 1
+        entry = [self.loop.time() + seconds, self.seq, callback]
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry:
+            self.rearm()
+        return entry
+
+    def cancel(self, entry):
+        entry[2] = None
+
+    def rearm(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+        if self.heap:
+            self.handle = self.loop.call_at(self.heap[0][0], self.fire)
+
+    def fire(self):
+        self.handle = None
+        now = self.loop.time()
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            callback = entry[2]
+            entry[2] = None
+            if callback is not None:
+                callback()
+        self.rearm()
+
+METRICS_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000) #histogram bucket tops, ms
+METRICS_LAG_INTERVAL = 0.5 #seconds between event loop lag samples
+METRICS_DUMP_INTERVAL = 300 #seconds between metrics lines in blackjack.log
+
+class Histogram():
+    """Latencies counted into fixed millisecond buckets"""
+    __slots__ = ("counts", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BOUNDS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(METRICS_BOUNDS, ms)] += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, pct):
+        """Top of the bucket holding the pct'th percentile, capped at the max seen"""
+        rank = sum(self.counts) * pct / 100
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(METRICS_BOUNDS[i], round(self.max, 2)) if i < len(METRICS_BOUNDS) else round(self.max, 2)
+        return 0.0
+
+    def summary(self):
+        count = sum(self.counts)
+        return {"count": count, "mean": round(self.total / count, 2) if count else 0.0,
+                "p50": self.percentile(50), "p90": self.percentile(90), "p99": self.percentile(99),
+                "max": round(self.max, 2)}
+
+
+class Metrics():
+    """Counters and latency histograms for the tables' hot paths.
+
+    Off until a mod turns it on.  While off, every hook is one attribute
+    test and a return, and the loop lag sampler and log dump don't run."""
+
+    def __init__(self):
+        self.enabled = False
+        self.tasks = []
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        if self.enabled:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds * 1000)
+
+    def since(self, name, start):
+        """Observe the time since start, a time.perf_counter() reading"""
+        if self.enabled:
+            self.observe(name, time.perf_counter() - start)
+
+    def start(self, loop, gauges):
+        """Start collecting.  gauges() returns per table state for reports."""
+        if self.enabled:
+            return
+        self.enabled = True
+        self.reset()
+        self.tasks = [loop.create_task(self.sample_lag(loop)), loop.create_task(self.dump(gauges))]
+
+    def stop(self):
+        self.enabled = False
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    async def sample_lag(self, loop):
+        """How late the loop wakes a sleeper is how long everything else waits"""
+        while True:
+            start = loop.time()
+            await asyncio.sleep(METRICS_LAG_INTERVAL)
+            self.observe("loop lag", loop.time() - start - METRICS_LAG_INTERVAL)
+
+    async def dump(self, gauges):
+        while True:
+            await asyncio.sleep(METRICS_DUMP_INTERVAL)
+            logger.info("metrics " + json.dumps(self.snapshot(gauges()), sort_keys=True))
+
+    def snapshot(self, tables):
+        return {"seconds": round(time.time() - self.started), "counters": dict(self.counters),
+                "latency_ms": {name: h.summary() for name, h in self.histograms.items()}, "tables": tables}
+
+    def report(self, tables):
+        snapshot = self.snapshot(tables)
+        lines = ["Last {} seconds".format(str(snapshot["seconds"]))]
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append("{:<20} {}".format(name, str(value)))
+        lines.append("{:<12} {:>7} {:>8} {:>7} {:>7} {:>7} {:>8}".format("latency ms", "count", "mean", "p50", "p90", "p99", "max"))
+        for name, h in sorted(snapshot["latency_ms"].items()):
+            lines.append("{:<12} {:>7} {:>8} {:>7} {:>7} {:>7} {:>8}".format(
+                name, str(h["count"]), str(h["mean"]), str(h["p50"]), str(h["p90"]), str(h["p99"]), str(h["max"])))
+        for channel, gauges in sorted(tables.items()):
+            lines.append("#{}: {players} players, {bets} bets, {rounds} rounds, {queued} queued, {inbox} in inbox, {dropped} dropped, {status}".format(channel, **gauges))
+        return "\n".join(lines)
+
+metrics = Metrics()
+
+
+MESSAGE_LIMIT = 2000 #Discord's cap on one message
+
+def pack_lines(lines, limit=MESSAGE_LIMIT):
+    """Join lines into as few messages of at most limit characters as
+       possible, in order.  A line too long for one message is split."""
+    chunks = []
+    chunk = ""
+    for line in lines:
+        if len(line) > limit:
+            if chunk:
+                chunks.append(chunk)
+            while len(line) > limit:
+                chunks.append(line[:limit])
+                line = line[limit:]
+            chunk = line
+        elif chunk and len(chunk) + 1 + len(line) > limit:
+            chunks.append(chunk)
+            chunk = line
+        elif chunk:
+            chunk = chunk + "\n" + line
+        else:
+            chunk = line
+    chunks.append(chunk)
+    return chunks
+
+#Outbox priorities, most urgent first
+PRIORITY_PROMPT = 0 #someone is waiting on this to act
+PRIORITY_PLAY = 1
+PRIORITY_STATS = 2
+
+class SendWindow():
+    """At most rate sends in any per seconds.  Keeps the loop times of
+    the last rate sends; another waits until the oldest is per old."""
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.sent = deque() #send times, oldest first
+
+    def expire(self, now):
+        while self.sent and now - self.sent[0] >= self.per:
+            self.sent.popleft()
+
+    def wait(self, now):
+        """Seconds until a send is allowed, 0 if one is now"""
+        self.expire(now)
+        if len(self.sent) < self.rate:
+            return 0
+        return self.sent[0] + self.per - now
+
+    def take(self, now):
+        self.sent.append(now)
+
+    def done(self, now):
+        """The last send finished at now.  Count it from then, as the
+           server saw it somewhere between take and done."""
+        if self.sent:
+            self.sent.pop()
+        self.sent.append(now)
+
+    def idle(self, now):
+        """True once nothing has been sent for per seconds"""
+        self.expire(now)
+        return not self.sent
+
+
+class OutboxChannel():
+    def __init__(self, channel, window):
+        self.channel = channel
+        self.window = window
+        self.pending = [] #heap of [priority, seq, content, key, stamp]
+        self.busy = False #a worker is sending for this channel
+
+
+class Outbox():
+    """Rate-limit-aware sender shared by every table.
+
+    Each channel has a send window sized to Discord's per channel limit
+    and every send also counts against one global window, so busy tables queue
+    here instead of stalling on 429 retries.  Pending messages go out by
+    priority, then age, and never more than one at a time per channel so
+    a channel's messages stay in order.  Sending with a key replaces a
+    queued message with the same key instead of adding another."""
+
+    def __init__(self, bot, rate=5, per=5.0, globalrate=40, globalper=1.0, workers=4):
+        self.bot = bot
+        self.loop = bot.loop
+        self.rate = rate
+        self.per = per
+        self.globalwindow = SendWindow(globalrate, globalper)
+        self.channels = {} #[channel id]OutboxChannel
+        self.wake = asyncio.Event()
+        self.seq = 0
+        self.sent = 0
+        self.merged = 0
+        self.limited = 0 #messages that had to wait on a window
+        self.held = set() #seq of each message counted in limited, until it's sent
+        self.failed = 0
+        self.tasks = [self.loop.create_task(self.run()) for _ in range(workers)]
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def pending(self):
+        return sum(len(q.pending) for q in self.channels.values())
+
+    def hand_off(self):
+        """Everything still queued, oldest first, and each window's recent
+           sends, for the outbox of a reloaded cog to take over"""
+        items = sorted(((q.channel, item) for q in self.channels.values() for item in q.pending), key=lambda entry: entry[1][1])
+        for q in self.channels.values():
+            q.pending = []
+        self.held.clear()
+        return {"pending": [(channel, content, priority, key, stamp) for channel, (priority, seq, content, key, stamp) in items],
+                "windows": [(q.channel, list(q.window.sent)) for q in self.channels.values()],
+                "global": list(self.globalwindow.sent)}
+
+    def take_over(self, state):
+        """Send what another outbox left queued, counting the sends it
+           already made against the limits"""
+        self.globalwindow.sent.extend(state["global"])
+        for channel, sent in state["windows"]:
+            window = SendWindow(self.rate, self.per)
+            window.sent.extend(sent)
+            self.channels[channel.id] = OutboxChannel(channel, window)
+        for channel, content, priority, key, stamp in state["pending"]:
+            self.send(channel, content, priority, key, stamp)
+
+    def send(self, channel, content, priority=PRIORITY_PLAY, key=None, stamp=None):
+        """Queue content for channel.  Returns immediately.
+           stamp is the loop time of the player action this answers, if any."""
+        q = self.channels.get(channel.id)
+        if q is None:
+            q = OutboxChannel(channel, SendWindow(self.rate, self.per))
+            self.channels[channel.id] = q
+        if key is not None:
+            for item in q.pending:
+                if item[3] == key:
+                    item[2] = content
+                    if item[4] is None:
+                        item[4] = stamp
+                    self.merged += 1
+                    return
+        self.seq += 1
+        heapq.heappush(q.pending, [priority, self.seq, content, key, stamp])
+        self.wake.set()
+
+    def next_ready(self):
+        """Pick the most urgent sendable message.
+           Returns (channel queue, item, None) or (None, None, seconds to wait)."""
+        now = self.loop.time()
+        globalwait = self.globalwindow.wait(now)
+        best = None
+        delay = None
+        idle = []
+        for channelid, q in self.channels.items():
+            if not q.pending:
+                if not q.busy and q.window.idle(now):
+                    idle.append(channelid)
+                continue
+            if q.busy:
+                continue
+            wait = max(q.window.wait(now), globalwait)
+            if wait:
+                self.hold(q.pending[0])
+                if delay is None or wait < delay:
+                    delay = wait
+            elif best is None or q.pending[0] < best.pending[0]:
+                best = q
+        for channelid in idle:
+            del self.channels[channelid]
+        if best is None:
+            return None, None, delay
+        best.window.take(now)
+        self.globalwindow.take(now)
+        item = heapq.heappop(best.pending)
+        self.held.discard(item[1])
+        return best, item, None
+
+    def hold(self, item):
+        """Count a message held back by a window, once however long it waits"""
+        if item[1] not in self.held:
+            self.held.add(item[1])
+            self.limited += 1
+
+    async def run(self):
+        while True:
+            q, item, delay = self.next_ready()
+            if q is None:
+                self.wake.clear()
+                try:
+                    await asyncio.wait_for(self.wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            q.busy = True
+            try:
+                await self.bot.send_message(q.channel, item[2])
+                self.sent += 1
+                metrics.count("api calls")
+                if item[4] is not None:
+                    metrics.observe("response", self.loop.time() - item[4])
+            except discord.HTTPException as e:
+                self.failed += 1
+                logger.info("Blackjack message to {} failed: {}".format(str(q.channel), str(e)))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                logger.exception("Blackjack message to {} failed".format(str(q.channel)))
+            finally:
+                q.window.done(self.loop.time())
+                q.busy = False
+                self.wake.set() #the channel may have more waiting
+
+
+#Every message in a table channel goes through parse_action, so the whole
+#command vocabulary is one compiled pattern, found with a single findall.
+#The pattern opens on a literal first letter, so the scan skips straight
+#to the next b, h, s or d and most chatter is turned away without ever
+#trying the word boundary.  A bet's amount is caught along with anything
+#that makes it malformed (a sign before it, letters or decimals after it).
+#Play words are caught without their first letter, so ACTION_ALIASES is
+#keyed by the rest of the word.
+ACTION_PATTERN = re.compile(r"[bhsd](?<=\b[bhsd])(?:et(\W{0,2})(\d+)(\w|[.,]\d)?|(it|tand|tay|ouble|plit|urrender)\b)", re.ASCII)
+ACTION_ALIASES = {"it": "hit", "tand": "stand", "tay": "stand", "ouble": "double", "plit": "split", "urrender": "surrender"}
+#Most commands are the whole message (give or take a "!"), and are
+#answered before the scan.
+ACTION_WORDS = {"bet": ("bet", None), "hit": ("hit", None), "stand": ("stand", None), "stay": ("stand", None),
+                "double": ("double", None), "split": ("split", None), "surrender": ("surrender", None)}
+
+#A turbo table takes a player's whole turn in one message: play words
+#only, optionally joined by "then" or "and", with "hit until 17" hitting
+#until the hand reaches 17 and then standing.  PLAN_STEPS reads the steps
+#out of a message PLAN_PATTERN has matched.
+PLAN_STEP = r"(?:hit(?:\s+until\s+\d+)?|stand|stay|double|split|surrender)"
+PLAN_PATTERN = re.compile(r"\W*{0}(?:\W+(?:(?:then|and)\W+)*{0})*\W*".format(PLAN_STEP), re.ASCII)
+PLAN_STEPS = re.compile(r"(hit|stand|stay|double|split|surrender)(?:\s+until\s+(\d+))?", re.ASCII)
+
+#What the listener hands a table.  kind is "bet" (amount None repeats the
+#last bet), "plan" (amount is its steps), "ambiguous" or one of the play
+#actions ACTION_ALIASES names.
+TableAction = namedtuple("TableAction", ("kind", "player", "amount"))
+INBOX_SIZE = 32 #actions a table holds before it drops new ones
+
+def parse_action(content):
+    """Parse a table message in a single pass.
+
+    Returns (action, amount).  action is "bet", "hit", "stand", "double",
+    "split", "surrender", "plan", "ambiguous" (more than one kind of action
+    named, or a bet that isn't a plain whole number) or None.  amount is
+    the bet for "bet", or None for a bare "bet" which repeats the player's
+    last one.  A message of nothing but play words naming more than one
+    kind of action, or a "hit until", is a "plan" and amount is its steps:
+    action names, and for "hit until 17" the total 17."""
+    content = content.lower()
+    quick = ACTION_WORDS.get(content.rstrip("!. "))
+    if quick is not None:
+        return quick
+    found = ACTION_PATTERN.findall(content) #most chatter stops here
+    if not found:
+        return (None, None)
+    if (len(found) > 1 or "until" in content) and PLAN_PATTERN.fullmatch(content):
+        steps = tuple(ACTION_WORDS[word][0] if total == "" else int(total) for word, total in PLAN_STEPS.findall(content))
+        if len(set(steps)) > 1 or not isinstance(steps[0], str):
+            return ("plan", steps)
+    action = None
+    amount = None
+    for separator, digits, junk, word in found:
+        if word:
+            kind = ACTION_ALIASES[word]
+        elif junk or "-" in separator or "+" in separator:
+            return ("ambiguous", None)
+        else:
+            kind = "bet"
+        if action is None:
+            action = kind
+            if digits:
+                amount = int(digits)
+        elif action != kind:
+            return ("ambiguous", None)
+    return (action, amount)
+
+#Basic strategy tables, generated offline for decks 1-8 by make_strategy.py
+#under this cog's rules.  Per deck count: rows hard 4-21, soft 12-21 and
+#pairs A-10, each ten action codes for dealer upcards 2-9, T, A.
+#H hit, S stand, D double else hit, d double else stand, P split,
+#R surrender else hit.
+STRATEGY_FILE = "data/blackjack/strategy.bin"
+STRATEGY_MAGIC = b"BJS1"
+STRATEGY_ROWS = 38
+STRATEGY_SECTIONS = ((0, 4, 18), (18, 12, 10), (28, 1, 10)) #(first row, first total, rows): hard, soft, pairs
+STRATEGY_CODES = "HSDdPR"
+HIT, STAND, DOUBLE, DOUBLE_STAND, SPLIT, SURRENDER = range(6)
+HINT_WORDS = {"H": "hit", "S": "stand", "D": "double (hit if you can't)", "d": "double (stand if you can't)",
+              "P": "split", "R": "surrender (hit if you can't)"}
+strategy_tables = None
+
+#House rules the table deals by, which its hints and the simulator follow too
+SURRENDER_AFTER_SPLIT = False
+
+def surrender_allowed(cards, split):
+    """Late surrender is for a two card hand, and a hand from a split only
+       under SURRENDER_AFTER_SPLIT.  Takes numbers, or numpy arrays for the
+       simulator, so both apply the same rule."""
+    return (cards == 2) & (split <= SURRENDER_AFTER_SPLIT)
+
+def load_strategy():
+    """The strategy tables as one bytes object, read from disk on first use"""
+    global strategy_tables
+    if strategy_tables is None:
+        with open(STRATEGY_FILE, "rb") as f:
+            data = f.read()
+        if data[:len(STRATEGY_MAGIC)] != STRATEGY_MAGIC or len(data) != len(STRATEGY_MAGIC) + 8 * STRATEGY_ROWS * 10:
+            raise ValueError(STRATEGY_FILE + " is not a strategy table file")
+        strategy_tables = data[len(STRATEGY_MAGIC):]
+    return strategy_tables
+
+def basic_strategy(hand, upcard, decks, split=False):
+    """Action code for hand against a dealer upcard value (1-10), O(1).
+       split says the hand came from a split."""
+    tables = load_strategy()
+    base = (min(max(decks, 1), 8) - 1) * STRATEGY_ROWS
+    column = 9 if upcard == 1 else upcard - 2
+    if hand.isSplittable():
+        code = chr(tables[(base + 28 + CARD_VALUES[hand.cards[0]] - 1) * 10 + column])
+        if code == "P":
+            return code
+    if hand.hasAce and hand.bjlowval <= 11:
+        row = 18 + hand.bjhighval - 12
+    else:
+        row = max(hand.bjlowval, 4) - 4
+    code = chr(tables[(base + row) * 10 + column])
+    if len(hand) != 2: #doubling is for the first two cards
+        code = {"D": "H", "d": "S"}.get(code, code)
+    if code == "R" and not surrender_allowed(len(hand), split):
+        code = "H"
+    return code
+
+def strategy_arrays(decks):
+    """numpy [total][dealer upcard value] action arrays (hard, soft, pairs)
+       for the simulator"""
+    tables = load_strategy()
+    base = (decks - 1) * STRATEGY_ROWS
+    arrays = []
+    for offset, first, rows in STRATEGY_SECTIONS:
+        array = numpy.zeros((32, 11), dtype=numpy.int8)
+        for row in range(rows):
+            for column in range(10):
+                upcard = 1 if column == 9 else column + 2
+                array[first + row, upcard] = STRATEGY_CODES.index(chr(tables[(base + offset + row) * 10 + column]))
+        arrays.append(array)
+    return arrays
+
+def sim_draw(rng, counts, shoes):
+    """Deal one card value (1-10) from each of the given distinct shoes.
+       counts holds each shoe's remaining cards per value, so this is exact
+       sampling without replacement using ten columns instead of a shuffle."""
+    cum = counts[shoes].cumsum(axis=1)
+    pick = (rng.random_sample(len(shoes)) * cum[:, -1]).astype(cum.dtype)
+    index = (cum <= pick[:, None]).sum(axis=1)
+    counts[shoes, index] -= 1
+    return index + 1
+
+def sim_totals(low, ace):
+    """bjhighval and softness for arrays of low totals and ace flags"""
+    soft = ace & (low <= 11)
+    return numpy.where(soft, low + 10, low), soft
+
+def simulate_chunk(rng, decks, n, tables, stats):
+    """Play n single seat rounds at once, each from a freshly shuffled shoe"""
+    hard, soft_table, pairs = tables
+    counts = numpy.tile(numpy.array([4] * 9 + [16], dtype=numpy.int32) * decks, (n, 1))
+    allshoes = numpy.arange(n)
+    p1 = sim_draw(rng, counts, allshoes)
+    up = sim_draw(rng, counts, allshoes)
+    p2 = sim_draw(rng, counts, allshoes)
+    hole = sim_draw(rng, counts, allshoes)
+    dlow = up + hole
+    dace = (up == 1) | (hole == 1)
+    dealerbj = dace & (dlow == 11)
+    playerbj = ((p1 == 1) | (p2 == 1)) & (p1 + p2 == 11)
+    net = numpy.zeros(n)
+    net[dealerbj & ~playerbj] = -1 #dealer blackjack takes everything but a push
+    net[~dealerbj & playerbj] = 2 #blackjack doubles the bet
+    stats["dealer_blackjacks"] += int(dealerbj.sum())
+    stats["player_blackjacks"] += int((~dealerbj & playerbj).sum())
+
+    live = allshoes[~dealerbj & ~playerbj]
+    #one row per player hand; splits append rows
+    shoe = live.copy()
+    first = p1[live]
+    low = p1[live] + p2[live]
+    ace = (p1[live] == 1) | (p2[live] == 1)
+    ncards = numpy.full(len(live), 2, dtype=numpy.int32)
+    bet = numpy.ones(len(live))
+    done = numpy.zeros(len(live), dtype=bool)
+    fromsplit = numpy.zeros(len(live), dtype=bool)
+    blackjack = numpy.zeros(len(live), dtype=bool)
+    busted = numpy.zeros(len(live), dtype=bool)
+    active = numpy.arange(len(live))
+    pending = numpy.zeros(0, dtype=numpy.int64)
+    while active.size:
+        while True:
+            rows = active[~done[active]]
+            if not rows.size:
+                break
+            total, soft = sim_totals(low[rows], ace[rows])
+            upcard = up[shoe[rows]]
+            two = ncards[rows] == 2
+            action = numpy.where(soft, soft_table[total, upcard], hard[total, upcard])
+            paired = two & (low[rows] == 2 * first[rows])
+            action = numpy.where(paired & (pairs[first[rows], upcard] == SPLIT), SPLIT, action)
+            action = numpy.where(~two & (action == DOUBLE), HIT, action)
+            action = numpy.where(~two & (action == DOUBLE_STAND), STAND, action)
+            action = numpy.where(action == DOUBLE_STAND, DOUBLE, action)
+            action = numpy.where(~surrender_allowed(ncards[rows], fromsplit[rows]) & (action == SURRENDER), HIT, action)
+
+            done[rows[action == STAND]] = True
+            surrender = rows[action == SURRENDER]
+            bet[surrender] = -0.5
+            done[surrender] = True
+            stats["surrenders"] += len(surrender)
+
+            split = rows[action == SPLIT]
+            if split.size:
+                stats["splits"] += len(split)
+                start = len(shoe)
+                shoe = numpy.concatenate((shoe, shoe[split]))
+                first = numpy.concatenate((first, first[split]))
+                low = numpy.concatenate((low, first[split]))
+                ace = numpy.concatenate((ace, first[split] == 1))
+                ncards = numpy.concatenate((ncards, numpy.ones(len(split), dtype=numpy.int32)))
+                bet = numpy.concatenate((bet, numpy.ones(len(split))))
+                done = numpy.concatenate((done, numpy.zeros(len(split), dtype=bool)))
+                fromsplit = numpy.concatenate((fromsplit, numpy.ones(len(split), dtype=bool)))
+                blackjack = numpy.concatenate((blackjack, numpy.zeros(len(split), dtype=bool)))
+                busted = numpy.concatenate((busted, numpy.zeros(len(split), dtype=bool)))
+                pending = numpy.concatenate((pending, numpy.arange(start, len(shoe))))
+                low[split] = first[split]
+                ace[split] = first[split] == 1
+                ncards[split] = 1
+                fromsplit[split] = True
+
+            double = rows[action == DOUBLE]
+            bet[double] *= 2
+            done[double] = True
+            stats["doubles"] += len(double)
+
+            drawing = rows[(action == HIT) | (action == DOUBLE) | (action == SPLIT)]
+            card = sim_draw(rng, counts, shoe[drawing])
+            low[drawing] += card
+            ace[drawing] |= card == 1
+            ncards[drawing] += 1
+            total, soft = sim_totals(low[drawing], ace[drawing])
+            splitbj = drawing[fromsplit[drawing] & (ncards[drawing] == 2) & (total == 21)]
+            blackjack[splitbj] = True
+            bet[splitbj] *= 2
+            stats["player_blackjacks"] += len(splitbj)
+            bust = drawing[total > 21]
+            busted[bust] = True
+            bet[bust] *= -1
+            done[drawing[total >= 21]] = True
+        #split hands wait their turn, one per shoe per wave so draws stay exact
+        if pending.size:
+            unique, index = numpy.unique(shoe[pending], return_index=True)
+            active = pending[index]
+            pending = numpy.delete(pending, index)
+            card = sim_draw(rng, counts, shoe[active])
+            low[active] += card
+            ace[active] |= card == 1
+            ncards[active] += 1
+            total, soft = sim_totals(low[active], ace[active])
+            splitbj = active[total == 21]
+            blackjack[splitbj] = True
+            bet[splitbj] *= 2
+            done[splitbj] = True
+            stats["player_blackjacks"] += len(splitbj)
+        else:
+            active = pending
+
+    #the dealer only plays when some hand besides a blackjack is still in
+    activehands = numpy.bincount(shoe[(bet > 0) & ~blackjack], minlength=n) > 0
+    playing = allshoes[activehands]
+    while playing.size:
+        total, soft = sim_totals(dlow[playing], dace[playing])
+        playing = playing[total < 17]
+        card = sim_draw(rng, counts, playing)
+        dlow[playing] += card
+        dace[playing] |= card == 1
+    dealertotal, soft = sim_totals(dlow, dace)
+    dealerbust = activehands & (dealertotal > 21)
+    stats["dealer_hands"] += int(activehands.sum())
+    stats["dealer_busts"] += int(dealerbust.sum())
+
+    total, soft = sim_totals(low, ace)
+    compare = (bet > 0) & activehands[shoe] & ~dealerbust[shoe]
+    dealer = dealertotal[shoe]
+    bet = numpy.where(compare & (dealer > total), -bet, bet)
+    bet = numpy.where(compare & (dealer == total), 0, bet)
+    net += numpy.bincount(shoe, weights=bet, minlength=n)
+
+    stats["rounds"] += n
+    stats["hands"] += n - len(live) + len(shoe)
+    stats["player_busts"] += int(busted.sum())
+    stats["net"] += float(net.sum())
+    stats["net_squared"] += float((net * net).sum())
+
+def simulate_rounds(decks, rounds, seed=None, chunk=100000, stop=None):
+    """Monte Carlo the house edge for one seat playing basic strategy.
+
+    Runs in the cog's simulator thread, a chunk of rounds at a time, and
+    stops early once stop is set.  Each round is dealt from a freshly
+    shuffled shoe of decks decks."""
+    rng = numpy.random.RandomState(seed)
+    tables = strategy_arrays(decks)
+    stats = dict.fromkeys(["rounds", "hands", "net", "net_squared", "player_busts", "dealer_hands", "dealer_busts",
+                           "player_blackjacks", "dealer_blackjacks", "doubles", "splits", "surrenders"], 0)
+    while stats["rounds"] < rounds and not (stop is not None and stop.is_set()):
+        simulate_chunk(rng, decks, min(chunk, rounds - stats["rounds"]), tables, stats)
+    return stats
+
+def combine_stats(parts):
+    """Add up simulate_rounds results and work out the edge and variance"""
+    stats = dict.fromkeys(parts[0], 0)
+    for part in parts:
+        for key in part:
+            stats[key] += part[key]
+    mean = stats["net"] / stats["rounds"]
+    stats["edge"] = -mean
+    stats["variance"] = stats["net_squared"] / stats["rounds"] - mean * mean
+    return stats
+
+def settle_round(bank, nets):
+    """Apply each player's net result for a round as one ledger operation.
+
+    nets maps players to credits won (negative for lost).  Every balance
+    is worked out and every loss checked before anything changes, then
+    written in one go with no await in between, so a failure part way
+    leaves nobody paid.  Returns settlement()'s (balances, overdrawn)."""
+    balances, overdrawn = settlement(bank, nets)
+    write_balances(bank, balances)
+    return balances, overdrawn
+
+def settlement(bank, nets):
+    """Work out the round's new balances without changing any.
+
+    A loss the player can no longer cover, because they spent the credits
+    somewhere else mid round, is neither taken nor forgiven: the player is
+    left out, for the caller to flag.  Returns ({player: new balance} for
+    everyone settled, {player: net} for everyone left out)."""
+    balances = {}
+    overdrawn = {}
+    for player, net in nets.items():
+        net = int(net)
+        if net < 0 and not bank.can_spend(player, -net):
+            overdrawn[player] = net
+        else:
+            balances[player] = bank.get_balance(player) + net
+    return balances, overdrawn
+
+def write_balances(bank, balances):
+    """Set every player's balance, saving the bank once"""
+    #Red's Economy bank saves its whole file on every set_credits, a dozen
+    #rewrites for a busy round.  So with that bank, and only when it still
+    #has the private accounts dict and _save_bank this relies on, the
+    #balances go straight into its accounts and it's saved once.
+    accounts = getattr(bank, "accounts", None)
+    if accounts is not None and hasattr(bank, "_save_bank"):
+        for player, balance in balances.items():
+            accounts[player.server.id][player.id]["balance"] = balance
+        bank._save_bank()
+        return
+    for player, balance in balances.items(): #any other bank, through its public API
+        bank.set_credits(player, balance)
+
+def get_bj_by_channel(channel):
+    """O(1) lookup of the table running in channel, or None"""
+    return bj_manager.bj_sessions.get(channel.id)
 
 async def check_messages(message):
+    #Runs for every message the bot sees, so reject cheaply: one dict miss
+    #for channels without a table, before any other attribute or await.
+    bjsession = bj_manager.bj_sessions.get(message.channel.id)
+    if bjsession is None:
+        return
     if message.author.id != bj_manager.bot.user.id:
-        if await get_bj_by_channel(message.channel):
-            bjsession = await get_bj_by_channel(message.channel)
-            await bjsession.check_command(message)
+        await bjsession.check_command(message)
 
 def check_folders():
     if not os.path.exists("data/blackjack"):
         print("Creating data/blackjack folder...")
         os.makedirs("data/blackjack")
+    if not os.path.exists(SERVER_SETTINGS_DIR):
+        print("Creating " + SERVER_SETTINGS_DIR + " folder...")
+        os.makedirs(SERVER_SETTINGS_DIR)
+    if not os.path.exists(JOURNAL_DIR):
+        print("Creating " + JOURNAL_DIR + " folder...")
+        os.makedirs(JOURNAL_DIR)
 
 def check_files():
-    settings = {"ACTIVE_TIMEOUT" : 45, "MIN_BET" : 10, "MAX_BET" : 1000, "DECKS" : 1, "ACTIVE_DELAY" : 20, "BET_TIMEOUT" : 10}
+    settings = dict(DEFAULT_SETTINGS)
 
     f = "data/blackjack/settings.json"
     if not fileIO(f, "check"):
@@ -588,6 +2711,13 @@ def setup(bot):
     bot.add_listener(check_messages, "on_message")
     bj_manager = Blackjack(bot)
     bot.add_cog(bj_manager)
+    handoff = getattr(bot, HANDOFF_ATTR, None)
+    if handoff is not None:
+        delattr(bot, HANDOFF_ATTR)
+    if handoff is not None and bot.loop.time() - handoff["time"] <= HANDOFF_TTL:
+        bj_manager.take_over(handoff)
+    else: #a fresh start, maybe after a crash
+        bot.loop.create_task(bj_manager.recover_wagers())
 
 
 """The below module contains code from
@@ -640,6 +2770,8 @@ class Deck(object):
     Attributes:
       cards: list of Card objects.
     """
+
+    __slots__ = ("cards",)
     
     def __init__(self):
         self.cards = []
@@ -687,26 +2819,102 @@ class Deck(object):
             hand.add_card(self.pop_card())
 
 
+#Compact card encoding used by Shoe and Hand.  A card is the integer
+#suit * 13 + rank - 1 (0-51), so a shoe costs one byte per card and every
+#per-card lookup is a precomputed table indexed by that integer.
+CARD_VALUES = bytes(min(c % 13 + 1, 10) for c in range(52))
+CARD_NAMES = tuple(Card.rank_names[c % 13 + 1] + " " + Card.suit_names[c // 13] for c in range(52))
+
+
 class Shoe(Deck):
-    """Represents a shoe with multiple decks of cards."""
+    """Represents a shoe with multiple decks of cards.
 
-    def __init__(self, deckcount=1):
-        self.cards = []
+    Attributes:
+      cards: bytearray of card integers, dealt from the end.
+      decks: number of decks the shoe was built from.
+      seed: seed of the shoe's own RNG, so the same seed deals the same cards.
+      dealt: cards dealt so far, counting any rebuilt shoes.
+      inplay: cards dealt this round, still on the table.
+    """
+
+    __slots__ = ("decks", "penetration", "cutcard", "seed", "rng", "dealt", "inplay")
+
+    def __init__(self, deckcount=1, penetration=100, seed=None):
         self.decks = deckcount  #default single deck!
-        for _ in range(self.decks):
-            for suit in range(4):
-                for rank in range(1, 14):
-                    card = Card(suit, rank)
-                    self.cards.append(card)
+        self.cards = bytearray(range(52)) * deckcount
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.dealt = 0
+        self.inplay = bytearray()
+        self.place_cut(penetration)
+
+    def __str__(self):
+        return ' '.join([CARD_NAMES[card] for card in self.cards])
+
+    def place_cut(self, penetration):
+        """Put the cut card after penetration percent of the shoe"""
+        self.penetration = penetration
+        self.cutcard = len(self.cards) * (100 - penetration) // 100
+
+    def cut_reached(self):
+        """True once the cut card has come out; finish the round, then reshuffle"""
+        return len(self.cards) <= self.cutcard
+
+    def shuffle(self):
+        self.rng.shuffle(self.cards)
+
+    def new_round(self):
+        """The table is cleared; cards dealt from now on are in play"""
+        self.inplay = bytearray()
+
+    def rebuild(self):
+        """Reshuffle the discards, every card but those in play, when the
+           shoe runs out mid-round.  The cut card counts as reached, so the
+           next round gets a fresh shoe."""
+        counts = [self.decks] * 52
+        for card in self.inplay:
+            counts[card] -= 1
+        self.cards = bytearray(card for card in range(52) for _ in range(counts[card]))
+        self.shuffle()
+        self.cutcard = len(self.cards)
+
+    def pop_card(self, i=-1):
+        """Deals a card.  A shoe emptied mid-round is rebuilt from its discards."""
+        if not self.cards:
+            self.rebuild()
+        self.dealt += 1
+        card = self.cards.pop(i)
+        self.inplay.append(card)
+        return card
 
     def __len__(self):
         return len(self.cards)
 
+def restore_hand(owner, isDealer, bet, cards):
+    """A Hand holding cards, as a handed-off table had it"""
+    hand = Hand(owner, isDealer, bet)
+    for card in cards:
+        hand.add_card(card)
+    return hand
+
+def shuffled_shoe(decks, penetration, seed=None):
+    """Builds, shuffles and cuts a shoe.  Safe to run in an executor."""
+    shoe = Shoe(decks, penetration, seed)
+    shoe.shuffle()
+    return shoe
+
+HIDDEN_CARD = ":question: :question:" #the dealer's hole card
+
 class Hand(Deck):
-    """Represents a hand of playing cards."""
+    """Represents a hand of playing cards.
+
+    The rendered string is cached and only rebuilt, by one join over the
+    precomputed card names, after add_card or reveal changes the hand."""
+
+    __slots__ = ("owner", "isDealer", "bet", "bjhighval", "bjlowval", "hasAce", "isBlackjack", "names", "rendered")
     
     def __init__(self, owner=None, isDealer=False, bet=0):
-        self.cards = []
+        self.cards = bytearray()
         self.owner = owner
         self.isDealer = isDealer
         self.bet = bet
@@ -714,68 +2922,71 @@ class Hand(Deck):
         self.bjlowval = 0
         self.hasAce = False
         self.isBlackjack = False
+        self.names = [] #CARD_NAMES of the cards, in order
+        self.rendered = None #cached __str__, None once the hand changes
 
     def __len__(self):
         return len(self.cards)
 
     def __str__(self):
-        output = ''
-        if self.isDealer: hideFirst = True
-        else: hideFirst = False
-        showing_val = 0
-        for card in self.cards:
-            if hideFirst:
-                output += ":question: :question: "
-                hideFirst = False
-            else:
-                if card.rank > 10: showing_val += 10
-                else: showing_val += card.rank
-                output += card.rank_names[card.rank] + " " + card.suit_names[card.suit] + " "
-        value_str = str(showing_val)
-        total_str = " Total: "
+        if self.rendered is None:
+            self.rendered = self.render()
+        return self.rendered
+
+    def render(self):
         if self.isDealer:
-            total_str = " Showing: "
-            if showing_val == 1:
-                value_str = "1/11"
+            names = [HIDDEN_CARD] + self.names[1:] if self.names else self.names
+            showing = self.bjlowval - CARD_VALUES[self.cards[0]] if self.cards else 0
+            value_str = " Showing: " + ("1/11" if showing == 1 else str(showing))
+        elif self.bjhighval == 21:
+            names = self.names
+            value_str = " Total: 21 !!"
+        elif self.hasAce and self.bjlowval <= 11:
+            names = self.names
+            value_str = " Total: " + str(self.bjlowval) + "/" + str(self.bjhighval)
         else:
-            if self.bjhighval == 21:
-                value_str = "21 !!"
-            elif self.hasAce and self.bjlowval <= 11:
-                value_str = str(self.bjlowval) + "/" + str(self.bjhighval)
-        output = self.owner.name + "'s hand: " + output + total_str + value_str
-        return output
+            names = self.names
+            value_str = " Total: " + str(self.bjlowval)
+        return "".join([self.owner.name, "'s hand: ", " ".join(names), " ", value_str])
+
+    def reveal(self):
+        """Turn the dealer's hole card over"""
+        self.isDealer = False
+        self.rendered = None
 
     def add_card(self, card):
-        """Adds a card to the hand.  
+        """Adds a card to the hand, a card integer or a Card from a Deck.  
            Updates low and high blackjack values.
            Updates Hand self.xxx info"""
+        if isinstance(card, Card):
+            card = card.suit * 13 + card.rank - 1
         self.cards.append(card)
-        if card.rank > 10:
-            self.bjlowval += 10
-        else:
-            self.bjlowval += card.rank
-            if card.rank == 1:
-                self.hasAce = True
-        if self.hasAce:
-            if (self.bjlowval + 10) <= 21:
-                self.bjhighval = self.bjlowval + 10
-            else:
-                self.bjhighval = self.bjlowval
+        self.names.append(CARD_NAMES[card])
+        self.rendered = None
+        value = CARD_VALUES[card]
+        self.bjlowval += value
+        if value == 1:
+            self.hasAce = True
+        if self.hasAce and self.bjlowval <= 11:
+            self.bjhighval = self.bjlowval + 10
         else:
             self.bjhighval = self.bjlowval
         if self.bjhighval == 21 and len(self.cards) == 2:
             self.isBlackjack = True
 
+    def pop_card(self, i=-1):
+        """Removes and returns a card, as a split does"""
+        self.names.pop(i)
+        self.rendered = None
+        return self.cards.pop(i)
+
     def isSplittable(self):
         """Returns True if hand can be split
            Two card hands only
-           Rank must be equal"""
+           Rank must be equal, or both ten-valued"""
         if len(self.cards) != 2:  
             return False
-        else:
-            if self.cards[0].rank == self.cards[1].rank:  return True
-            elif self.cards[0].rank >= 10 and self.cards[1].rank >= 10: return True
-        return False
+        return CARD_VALUES[self.cards[0]] == CARD_VALUES[self.cards[1]]
 
 
 def find_defining_class(obj, method_name):
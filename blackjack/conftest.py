@@ -0,0 +1,36 @@
+"""pytest setup for the blackjack tests.
+
+The cog imports discord.py and Red's cogs.utils, so the tests need a Red
+install.  Point RED_HOME at its root folder (or run pytest from there)
+and this folder's blackjack.py is loaded as cogs.blackjack, ahead of any
+copy installed in Red's cogs folder.  Without Red the tests are skipped.
+
+    RED_HOME=path/to/Red-DiscordBot python -m pytest
+"""
+import importlib.util
+import os
+import sys
+
+import __main__
+
+RED_HOME = os.environ.get("RED_HOME", os.getcwd())
+COG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "blackjack.py")
+
+
+def load_cog():
+    sys.path.insert(0, RED_HOME)
+    try:
+        import discord
+        import cogs.utils.dataIO
+    except ImportError:
+        return
+    if not hasattr(__main__, "send_cmd_help"):  #the cog imports this from Red's red.py
+        async def send_cmd_help(ctx):
+            pass
+        __main__.send_cmd_help = send_cmd_help
+    spec = importlib.util.spec_from_file_location("cogs.blackjack", COG_FILE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["cogs.blackjack"] = module
+    spec.loader.exec_module(module)
+
+load_cog()
@@ -0,0 +1,194 @@
+"""Generates data/strategy.bin, the basic strategy tables the blackjack cog
+answers hints from, for every deck count blackjackset decks allows.
+
+    python make_strategy.py
+
+The rules are the cog's own: the dealer peeks for blackjack and stands on
+all 17s, blackjack doubles the bet (after a split too), any two cards may
+be doubled, the hand as dealt may be surrendered (a split hand only under
+SURRENDER_AFTER_SPLIT, which matches the cog's), and any pair may be split
+again and again.
+
+Dealer outcomes are exact for the shoe less the upcard.  Player draws use
+the shoe less the upcard as well, which gives total-dependent basic
+strategy rather than composition-dependent play.
+
+File layout: the magic b"BJS1", then for decks 1-8 the rows hard 4-21,
+soft 12-21 and pairs A-10, each row ten ASCII action codes for dealer
+upcards 2-9, T, A.  H hit, S stand, D double else hit, d double else
+stand, P split, R surrender else hit.
+"""
+import os
+import sys
+
+MAGIC = b"BJS1"
+HARD_ROWS = range(4, 22)
+SOFT_ROWS = range(12, 22)
+PAIR_ROWS = range(1, 11)
+UPCARDS = [2, 3, 4, 5, 6, 7, 8, 9, 10, 1]  #column order
+SURRENDER_AFTER_SPLIT = False  #blackjack.py's house rule of the same name
+
+
+def shoe_counts(decks):
+    """Cards per value 1-10 (ace is 1, all ten-valued cards are 10)"""
+    counts = [0] + [4 * decks] * 9 + [16 * decks]
+    return counts
+
+
+def high_total(low, ace):
+    return low + 10 if ace and low <= 11 else low
+
+
+def dealer_outcomes(decks, upcard):
+    """Probabilities of the dealer's final 17-21 or bust (22), given the
+    upcard and that the dealer did not have blackjack"""
+    memo = {}
+
+    def play(low, ace, counts):
+        total = high_total(low, ace)
+        if total >= 17:
+            return {min(total, 22): 1.0}
+        key = (low, ace, tuple(counts))
+        if key in memo:
+            return memo[key]
+        remaining = sum(counts)
+        result = {}
+        for value in range(1, 11):
+            if not counts[value]:
+                continue
+            p = counts[value] / remaining
+            counts[value] -= 1
+            for outcome, q in play(low + value, ace or value == 1, counts).items():
+                result[outcome] = result.get(outcome, 0.0) + p * q
+            counts[value] += 1
+        memo[key] = result
+        return result
+
+    counts = shoe_counts(decks)
+    counts[upcard] -= 1
+    holes = [value for value in range(1, 11) if not (upcard == 1 and value == 10) and not (upcard == 10 and value == 1)]
+    remaining = sum(counts[value] for value in holes)
+    result = {}
+    for hole in holes:
+        p = counts[hole] / remaining
+        counts[hole] -= 1
+        for outcome, q in play(upcard + hole, upcard == 1 or hole == 1, counts).items():
+            result[outcome] = result.get(outcome, 0.0) + p * q
+        counts[hole] += 1
+    return result
+
+
+class Solver:
+    """Expected values for one deck count and dealer upcard"""
+
+    def __init__(self, decks, upcard):
+        self.dealer = dealer_outcomes(decks, upcard)
+        counts = shoe_counts(decks)
+        counts[upcard] -= 1
+        remaining = sum(counts)
+        self.p = [counts[value] / remaining for value in range(11)]
+        self.hitmemo = {}
+
+    def stand(self, total):
+        if total > 21:
+            return -1.0
+        ev = 0.0
+        for outcome, q in self.dealer.items():
+            if outcome == 22 or outcome < total:
+                ev += q
+            elif outcome > total:
+                ev -= q
+        return ev
+
+    def hit(self, low, ace):
+        """Value of hitting, then playing hit/stand optimally"""
+        key = (low, ace)
+        if key not in self.hitmemo:
+            ev = 0.0
+            for value in range(1, 11):
+                ev += self.p[value] * self.best(low + value, ace or value == 1)
+            self.hitmemo[key] = ev
+        return self.hitmemo[key]
+
+    def best(self, low, ace):
+        total = high_total(low, ace)
+        if total > 21:
+            return -1.0
+        if total == 21:
+            return self.stand(21)
+        return max(self.stand(total), self.hit(low, ace))
+
+    def double(self, low, ace):
+        ev = 0.0
+        for value in range(1, 11):
+            ev += self.p[value] * self.stand(high_total(low + value, ace or value == 1))
+        return 2 * ev
+
+    def options(self, low, ace, split=False):
+        """Two card hand: value of each action"""
+        total = high_total(low, ace)
+        options = {"S": self.stand(total), "H": self.hit(low, ace), "D": self.double(low, ace)}
+        if SURRENDER_AFTER_SPLIT or not split:
+            options["R"] = -0.5
+        return options
+
+    def code(self, low, ace):
+        options = self.options(low, ace)
+        action = max(options, key=options.get)
+        if action == "D" and options["S"] > options["H"]:
+            return "d"
+        return action
+
+    def split(self, value):
+        """Value of splitting a pair of value, resplits allowed"""
+        blackjack = 2 * (1 - self.dealer.get(21, 0.0))  #a split blackjack pushes a dealer 21
+        hand = 0.0
+        for _ in range(50):  #fixed point of hand = sum p * value of the hand drawn to
+            new = 0.0
+            for card in range(1, 11):
+                low = value + card
+                ace = value == 1 or card == 1
+                if high_total(low, ace) == 21:
+                    ev = blackjack
+                else:
+                    ev = max(self.options(low, ace, split=True).values())
+                    if card == value:
+                        ev = max(ev, 2 * hand)
+                new += self.p[card] * ev
+            if abs(new - hand) < 1e-12:
+                break
+            hand = new
+        return 2 * hand
+
+
+def tables(decks):
+    rows = []
+    solvers = [Solver(decks, upcard) for upcard in UPCARDS]
+    for total in HARD_ROWS:
+        rows.append("".join(solver.code(total, False) for solver in solvers))
+    for total in SOFT_ROWS:
+        rows.append("".join(solver.code(total - 10, True) for solver in solvers))
+    for value in PAIR_ROWS:
+        row = ""
+        for solver in solvers:
+            unsplit = max(solver.options(2 * value, value == 1).values())
+            row += "P" if solver.split(value) > unsplit else solver.code(2 * value, value == 1)
+        rows.append(row)
+    return rows
+
+
+def main(path):
+    data = bytearray(MAGIC)
+    for decks in range(1, 9):
+        rows = tables(decks)
+        print("{} deck{}".format(decks, "" if decks == 1 else "s"))
+        for label, row in zip(["hard {}".format(t) for t in HARD_ROWS] + ["soft {}".format(t) for t in SOFT_ROWS] +
+                              ["pair {}".format(v) for v in PAIR_ROWS], rows):
+            print("  {:<8} {}".format(label, row))
+        data += "".join(rows).encode("ascii")
+    with open(path, "wb") as f:
+        f.write(bytes(data))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "strategy.bin"))
@@ -0,0 +1,666 @@
+"""Tests for the blackjack cog.  conftest.py says how to run them."""
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+import pytest
+
+blackjack = pytest.importorskip("cogs.blackjack", reason="needs a Red install, see conftest.py")
+import make_strategy
+blackjack.logger = logging.getLogger("blackjack") #setup() makes it in a running bot
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class DataFolderTest(unittest.TestCase):
+    """Runs each test in a throwaway folder holding the cog's data folders,
+    with a loop of its own"""
+
+    def setUp(self):
+        self.home = os.getcwd()
+        self.workdir = tempfile.mkdtemp(prefix="blackjack-test-")
+        os.chdir(self.workdir)
+        blackjack.check_folders()
+        blackjack.check_files()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        os.chdir(self.home)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class PublicBank():
+    """A bank with only Economy's public calls, by player id"""
+
+    def __init__(self, balances):
+        self.balances = dict(balances)
+
+    def account_exists(self, player):
+        return player.id in self.balances
+
+    def can_spend(self, player, amount):
+        return self.balances[player.id] >= amount
+
+    def get_balance(self, player):
+        return self.balances[player.id]
+
+    def set_credits(self, player, amount):
+        self.balances[player.id] = amount
+
+
+class EconomyBank(PublicBank):
+    """Red's Economy bank as settle_round sees it: accounts by server, and
+    a save of the whole file on every change"""
+
+    def __init__(self, balances):
+        self.accounts = {"0": {playerid: {"balance": balance} for playerid, balance in balances.items()}}
+        self.saves = 0
+
+    @property
+    def balances(self):
+        return {playerid: account["balance"] for playerid, account in self.accounts["0"].items()}
+
+    def get_balance(self, player):
+        return self.accounts[player.server.id][player.id]["balance"]
+
+    def can_spend(self, player, amount):
+        return self.get_balance(player) >= amount
+
+    def set_credits(self, player, amount):
+        self.accounts[player.server.id][player.id]["balance"] = amount
+        self._save_bank()
+
+    def _save_bank(self):
+        self.saves += 1
+
+
+class RedBot():
+    """As much of Red's bot as starting the cog needs"""
+
+    def __init__(self, loop, bank):
+        self.loop = loop
+        self.user = blackjack.ReplayUser(0, "Dealer")
+        self.economy = Economy(bank)
+
+    def get_cog(self, name):
+        return self.economy if name == "Economy" else None
+
+Economy = collections.namedtuple("Economy", ("bank",))
+Server = collections.namedtuple("Server", ("id",))
+
+
+class PackLinesTest(unittest.TestCase):
+
+    def test_short_lines_share_a_message(self):
+        self.assertEqual(blackjack.pack_lines(["a", "b", "c"]), ["a\nb\nc"])
+
+    def test_full_message_starts_another(self):
+        self.assertEqual(blackjack.pack_lines(["a" * 6, "b" * 4], limit=10), ["a" * 6, "b" * 4])
+
+    def test_oversized_line_keeps_its_place(self):
+        chunks = blackjack.pack_lines(["short", "x" * 25, "after"], limit=12)
+        self.assertEqual(chunks, ["short", "x" * 12, "x" * 12, "x\nafter"])
+
+    def test_oversized_line_first(self):
+        self.assertEqual(blackjack.pack_lines(["x" * 20, "y"], limit=10), ["x" * 10, "x" * 10, "y"])
+
+    def test_no_message_over_the_limit(self):
+        lines = ["line {}".format(i) * (i % 7 + 1) for i in range(500)] + ["z" * 4500]
+        chunks = blackjack.pack_lines(lines)
+        self.assertTrue(all(len(chunk) <= blackjack.MESSAGE_LIMIT for chunk in chunks))
+        self.assertEqual("\n".join(chunks).replace("\n", ""), "".join(lines))
+
+
+class ParseActionTest(unittest.TestCase):
+
+    def test_commands(self):
+        self.assertEqual(blackjack.parse_action("Hit!"), ("hit", None))
+        self.assertEqual(blackjack.parse_action("stay"), ("stand", None))
+        self.assertEqual(blackjack.parse_action("ok I'll double"), ("double", None))
+        self.assertEqual(blackjack.parse_action("split split"), ("split", None))
+
+    def test_bets(self):
+        self.assertEqual(blackjack.parse_action("bet 50"), ("bet", 50))
+        self.assertEqual(blackjack.parse_action("bet:200"), ("bet", 200))
+        self.assertEqual(blackjack.parse_action("bet"), ("bet", None))
+
+    def test_chatter(self):
+        for content in ("I understand the rules", "what's the minimum bet here?", "shit", "abet", "gg"):
+            self.assertEqual(blackjack.parse_action(content), (None, None), content)
+
+    def test_two_kinds_are_ambiguous(self):
+        self.assertEqual(blackjack.parse_action("hit or stand?"), ("ambiguous", None))
+        self.assertEqual(blackjack.parse_action("bet 5 and hit"), ("ambiguous", None))
+
+    def test_malformed_bets_are_ambiguous(self):
+        for content in ("bet -5", "bet +5", "bet 5.5", "bet 50k", "bet 1,000", "bet 5 then bet -5"):
+            self.assertEqual(blackjack.parse_action(content), ("ambiguous", None), content)
+
+    def test_plans(self):
+        self.assertEqual(blackjack.parse_action("hit hit stand"), ("plan", ("hit", "hit", "stand")))
+        self.assertEqual(blackjack.parse_action("Hit until 17!"), ("plan", (17,)))
+        self.assertEqual(blackjack.parse_action("hit, then stay"), ("plan", ("hit", "stand")))
+        self.assertEqual(blackjack.parse_action("I'll hit then stand"), ("ambiguous", None))
+        self.assertEqual(blackjack.parse_action("hit until you win"), ("hit", None))
+
+
+def card(value, suit=0):
+    """The card integer of a value 1-10 (10 is a ten)"""
+    return suit * 13 + value - 1
+
+
+class SurrenderRuleTest(unittest.TestCase):
+    """The table, its hints, the strategy generator and the simulator all
+    follow SURRENDER_AFTER_SPLIT"""
+
+    def setUp(self):
+        self.rule = blackjack.SURRENDER_AFTER_SPLIT
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        blackjack.SURRENDER_AFTER_SPLIT = self.rule
+        blackjack.strategy_tables = None
+        self.loop.close()
+
+    def table_surrenders(self, split):
+        """Whether the table takes a surrender of a 7 and 9, dealt or split"""
+        table = blackjack.ReplayTable(self.loop)
+        session = blackjack.BlackjackSession(blackjack.ReplayMessage(blackjack.ReplayChannel(1)),
+                                             dict(blackjack.DEFAULT_SETTINGS), seed=1, manager=table)
+        session.shoe = blackjack.shuffled_shoe(1, 75, 1)
+        player = blackjack.ReplayUser(1)
+        session.activeUser = player
+        session.bets[player] = 10
+        hands = [blackjack.restore_hand(player, False, 10, [card(7), card(9)])]
+        if split:
+            hands.append(blackjack.restore_hand(player, False, 10, [card(7, 1), card(9, 1)]))
+        session.hands[player] = hands
+        session.dealerhand = blackjack.restore_hand(None, True, 0, [card(7), card(10)])
+        session.round = blackjack.RoundRecord(0, session.shoe, [(player, 10, 1000)])
+        codes = blackjack.JOURNAL_CODES
+        session.script = collections.deque([(0, codes["surrender"]), (0, codes["stand"])])
+        self.loop.run_until_complete(session.active_dealer(0))
+        return hands[0].bet < 0
+
+    def simulator_surrenders(self):
+        """Surrenders when the simulator splits 8s against a ten, where its
+        tables say to surrender every other hand"""
+        tables = [numpy.full((32, 11), blackjack.SURRENDER, dtype=numpy.int8) for _ in range(2)]
+        tables.append(numpy.full((32, 11), blackjack.SPLIT, dtype=numpy.int8))
+        cards = itertools.chain([8, 10, 8, 7, 3, 10, 2], itertools.repeat(10))
+        def draw(rng, counts, shoes):
+            return numpy.array([next(cards) for _ in shoes], dtype=numpy.int32)
+        stats = dict.fromkeys(["rounds", "hands", "net", "net_squared", "player_busts", "dealer_hands", "dealer_busts",
+                               "player_blackjacks", "dealer_blackjacks", "doubles", "splits", "surrenders"], 0)
+        real_draw = blackjack.sim_draw
+        blackjack.sim_draw = draw
+        try:
+            blackjack.simulate_chunk(None, 1, 1, tables, stats)
+        finally:
+            blackjack.sim_draw = real_draw
+        self.assertEqual(stats["splits"], 1)
+        return stats["surrenders"]
+
+    def test_table_takes_surrender_of_the_dealt_hand(self):
+        self.assertTrue(self.table_surrenders(split=False))
+
+    def test_table_and_simulator_agree(self):
+        for rule in (False, True):
+            blackjack.SURRENDER_AFTER_SPLIT = rule
+            self.assertEqual(self.table_surrenders(split=True), rule)
+            if numpy is not None:
+                self.assertEqual(self.simulator_surrenders(), 2 if rule else 0)
+
+    def test_hints_follow_the_rule(self):
+        blackjack.strategy_tables = b"R" * (8 * blackjack.STRATEGY_ROWS * 10)  #surrender everything
+        hand = blackjack.restore_hand(None, False, 10, [card(7), card(9)])
+        self.assertEqual(blackjack.basic_strategy(hand, 10, 1), "R")
+        self.assertEqual(blackjack.basic_strategy(hand, 10, 1, split=True), "H")
+        blackjack.SURRENDER_AFTER_SPLIT = True
+        self.assertEqual(blackjack.basic_strategy(hand, 10, 1, split=True), "R")
+
+    def test_strategy_generator_uses_the_same_rule(self):
+        self.assertEqual(make_strategy.SURRENDER_AFTER_SPLIT, blackjack.SURRENDER_AFTER_SPLIT)
+
+    @unittest.skipIf(numpy is None, "needs numpy")
+    def test_simulator_stops_between_chunks(self):
+        blackjack.strategy_tables = b"S" * (8 * blackjack.STRATEGY_ROWS * 10)
+        stop = threading.Event()
+        def chunk(rng, decks, rounds, tables, stats):
+            stats["rounds"] += rounds
+            stop.set() #the cog unloads while the first chunk runs
+        real_chunk = blackjack.simulate_chunk
+        blackjack.simulate_chunk = chunk
+        try:
+            stats = blackjack.simulate_rounds(1, 1000, seed=1, chunk=100, stop=stop)
+        finally:
+            blackjack.simulate_chunk = real_chunk
+        self.assertEqual(stats["rounds"], 100)
+
+
+class PlanTest(unittest.TestCase):
+    """A turbo player's whole turn sent as one message"""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def play(self, content, turbo=True, cards=(2, 3), draws=(4, 5, 6, 10, 10)):
+        """Play one turn of a hand of cards with the player's only message
+           content, drawing draws from the shoe.  Returns (hand, what the table said)."""
+        table = blackjack.ReplayTable(self.loop)
+        channel = blackjack.ReplayChannel(1)
+        settings = dict(blackjack.DEFAULT_SETTINGS, ACTIVE_DELAY=0.05, TURBO=[channel.id] if turbo else [])
+        session = blackjack.BlackjackSession(blackjack.ReplayMessage(channel), settings, seed=1, manager=table)
+        session.shoe = blackjack.shuffled_shoe(1, 75, 1)
+        session.shoe.cards[-len(draws):] = [card(value) for value in reversed(draws)]
+        player = blackjack.ReplayUser(1)
+        table.bank.balances[player.id] = 1000
+        session.activeUser = player
+        session.bets[player] = 10
+        hand = blackjack.restore_hand(player, False, 10, [card(value) for value in cards])
+        session.hands[player] = [hand]
+        session.dealerhand = blackjack.restore_hand(None, True, 0, [card(7), card(10)])
+        action, amount = blackjack.parse_action(content)
+        session.post(blackjack.TableAction(action, player, amount))
+        self.loop.run_until_complete(session.active_dealer(0))
+        session.flush()
+        return hand, "\n".join(table.output)
+
+    def test_steps_play_in_order(self):
+        hand, said = self.play("hit hit stand")
+        self.assertEqual(len(hand), 4) #2, 3, 4, 5
+        self.assertIn("player1 stands.", said)
+        self.assertNotIn("timed out", said)
+
+    def test_hit_until(self):
+        hand, said = self.play("hit until 17")
+        self.assertEqual(hand.bjhighval, 20) #2, 3, 4, 5, 6
+        self.assertIn("player1 stands.", said)
+
+    def test_a_bust_ends_the_plan(self):
+        hand, said = self.play("hit hit hit hit stand", cards=(10, 2), draws=(4, 10, 10))
+        self.assertEqual(len(hand), 4) #10, 2, 4, 10
+        self.assertLess(hand.bet, 0)
+        self.assertNotIn("stands", said)
+
+    def test_turn_waits_once_the_plan_runs_out(self):
+        hand, said = self.play("double hit", cards=(5, 6), draws=(2, 2))
+        self.assertEqual(len(hand), 3) #the double was the last card
+        self.assertEqual(hand.bet, 20)
+
+    def test_only_turbo_tables_take_plans(self):
+        hand, said = self.play("hit hit stand", turbo=False)
+        self.assertEqual(len(hand), 2)
+        self.assertIn("one action at a time", said)
+        self.assertIn("timed out", said)
+
+
+class SettingsStoreTest(DataFolderTest):
+
+    def path(self, serverid):
+        return os.path.join(blackjack.SERVER_SETTINGS_DIR, serverid + ".json")
+
+    def saved(self, serverid):
+        with open(self.path(serverid)) as f:
+            return json.load(f)
+
+    def test_saved_servers_load_with_the_cog(self):
+        with open(self.path("42"), "w") as f:
+            json.dump({"DECKS": 4}, f)
+        store = blackjack.SettingsStore(self.loop)
+        os.remove(self.path("42")) #get() doesn't go back to the disk
+        self.assertEqual(store.get(Server("42"))["DECKS"], 4)
+        self.assertEqual(store.get(Server("43")), store.defaults)
+
+    def test_close_writes_what_is_waiting(self):
+        store = blackjack.SettingsStore(self.loop, delay=60)
+        store.set(Server("42"), "DECKS", 6)
+        store.close()
+        self.assertEqual(self.saved("42")["DECKS"], 6)
+        self.assertEqual(os.listdir(blackjack.SERVER_SETTINGS_DIR), ["42.json"])
+
+    def test_close_during_a_write(self):
+        store = blackjack.SettingsStore(self.loop, delay=0)
+        store.lock.acquire() #holds the executor's write back
+        store.set(Server("42"), "DECKS", 2)
+        self.loop.run_until_complete(asyncio.sleep(0.05)) #the save hands its write to the executor
+        store.set(Server("42"), "DECKS", 3)
+        store.lock.release()
+        store.close()
+        self.loop.run_until_complete(store.writing["42"])
+        self.assertEqual(self.saved("42")["DECKS"], 3)
+
+    def test_an_older_write_never_lands_on_a_newer_one(self):
+        store = blackjack.SettingsStore(self.loop)
+        store.write("42", 2, json.dumps({"DECKS": 3}))
+        store.write("42", 1, json.dumps({"DECKS": 2}))
+        self.assertEqual(self.saved("42")["DECKS"], 3)
+
+
+class RecoverWagersTest(DataFolderTest):
+    """Rounds a crash cut short, dealt from seed 1 to players 1 and 2 who
+    bet 10 each from 1000.  Standing, player 1 wins and player 2 loses."""
+
+    def setUp(self):
+        super().setUp()
+        self.bank = PublicBank({"1": 1000, "2": 1000})
+        self.wagers = blackjack.WagerLog(self.loop)
+
+    def log_round(self, actions, settles=()):
+        """Log a round up to where the crash stopped it.  Returns its id."""
+        roundid = self.wagers.open_round()
+        players = [(blackjack.ReplayUser(1), 10, 1000), (blackjack.ReplayUser(2), 10, 1000)]
+        self.wagers.deal(roundid, blackjack.ReplayChannel(5), blackjack.RoundRecord(0, blackjack.shuffled_shoe(1, 75, 1), players))
+        for player, action in actions:
+            self.wagers.action(roundid, player, action)
+        self.wagers.settle(roundid, [(blackjack.ReplayUser(player), before, after) for player, before, after in settles])
+        self.written(self.wagers)
+        return roundid
+
+    def written(self, wagers):
+        async def wait():
+            wagers.sync()
+            while wagers.writing is not None:
+                await asyncio.sleep(0.01)
+        self.loop.run_until_complete(wait())
+
+    def recover(self):
+        """Start the cog fresh, as after a crash.  Returns the balances."""
+        cog = blackjack.Blackjack(RedBot(self.loop, self.bank))
+        try:
+            self.loop.run_until_complete(cog.recover_wagers())
+            self.written(cog.wagers)
+        finally:
+            cog.outbox.close()
+            cog.playerstats.close()
+            self.loop.run_until_complete(asyncio.gather(*cog.outbox.tasks, return_exceptions=True))
+        return self.bank.balances
+
+    def test_logged_settlement(self):
+        self.log_round([(0, "stand"), (1, "stand")], settles=[(1, 1000, 1010), (2, 1000, 990)])
+        self.assertEqual(self.recover(), {"1": 1010, "2": 990})
+
+    def test_round_cut_short_settles_finished_hands_only(self):
+        self.log_round([(0, "stand")]) #crashed waiting on player 2
+        self.assertEqual(self.recover(), {"1": 1010, "2": 1000})
+
+    def test_round_nobody_played_changes_nothing(self):
+        self.log_round([])
+        self.assertEqual(self.recover(), {"1": 1000, "2": 1000})
+
+    def test_balance_moved_since(self):
+        self.log_round([(0, "stand"), (1, "stand")], settles=[(1, 1000, 1010), (2, 1000, 990)])
+        self.bank.balances["1"] = 1500 #another game paid out first
+        self.assertEqual(self.recover(), {"1": 1500, "2": 990})
+
+    def test_running_twice(self):
+        self.log_round([(0, "stand")])
+        with open(blackjack.WAGER_FILE, "rb") as f:
+            logged = f.read()
+        self.recover()
+        with open(blackjack.WAGER_FILE, "wb") as f: #as if the first run crashed before compacting
+            f.write(logged)
+        self.assertEqual(self.recover(), {"1": 1010, "2": 1000})
+        self.assertEqual(blackjack.read_wagers(blackjack.WAGER_FILE), {})
+
+    def test_unrecovered_rounds_stay_in_the_log(self):
+        broken = self.log_round([(1, "stand")]) #player 2 acting in player 1's turn
+        del self.bank.balances["2"]
+        missing = self.log_round([(0, "stand"), (1, "stand")])
+        self.assertEqual(self.recover(), {"1": 1010})
+        self.assertEqual(set(blackjack.read_wagers(blackjack.WAGER_FILE)), {broken, missing})
+        self.bank.balances["2"] = 1000 #an operator restores the account
+        self.assertEqual(self.recover(), {"1": 1010, "2": 990})
+
+
+class SettleRoundTest(unittest.TestCase):
+
+    def setUp(self):
+        self.players = [blackjack.ReplayUser(i) for i in (1, 2, 3)]
+
+    def settle(self, bank, nets):
+        return blackjack.settle_round(bank, dict(zip(self.players, nets)))
+
+    def test_economy_bank_is_saved_once(self):
+        bank = EconomyBank({"1": 100, "2": 100, "3": 100})
+        balances, overdrawn = self.settle(bank, [20, -10, 0])
+        self.assertEqual(bank.balances, {"1": 120, "2": 90, "3": 100})
+        self.assertEqual(bank.saves, 1)
+        self.assertEqual(balances, dict(zip(self.players, [120, 90, 100])))
+        self.assertEqual(overdrawn, {})
+
+    def test_other_banks_through_set_credits(self):
+        bank = PublicBank({"1": 100, "2": 100, "3": 100})
+        self.settle(bank, [20, -10, 0])
+        self.assertEqual(bank.balances, {"1": 120, "2": 90, "3": 100})
+
+    def test_overdraw_is_neither_taken_nor_forgiven(self):
+        for bank in (EconomyBank({"1": 100, "2": 5, "3": 100}), PublicBank({"1": 100, "2": 5, "3": 100})):
+            balances, overdrawn = self.settle(bank, [20, -10, -5])
+            self.assertEqual(bank.balances, {"1": 120, "2": 5, "3": 95})
+            self.assertEqual(overdrawn, {self.players[1]: -10})
+            self.assertNotIn(self.players[1], balances)
+
+    def test_settlement_changes_nothing(self):
+        bank = EconomyBank({"1": 100, "2": 100, "3": 100})
+        blackjack.settlement(bank, dict(zip(self.players, [20, -10, 0])))
+        self.assertEqual(bank.balances, {"1": 100, "2": 100, "3": 100})
+        self.assertEqual(bank.saves, 0)
+
+    def test_table_flags_an_overdraw(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            table = blackjack.ReplayTable(loop)
+            session = blackjack.BlackjackSession(blackjack.ReplayMessage(blackjack.ReplayChannel(1)),
+                                                 dict(blackjack.DEFAULT_SETTINGS), seed=1, manager=table)
+            winner, loser = self.players[:2]
+            table.bank.balances.update({winner.id: 100, loser.id: 5}) #spent at another table since betting 10
+            session.hands = {winner: [blackjack.restore_hand(winner, False, 10, [card(10), card(9)])],
+                             loser: [blackjack.restore_hand(loser, False, -10, [card(10), card(6)])]}
+            loop.run_until_complete(session.analyze_bets())
+            session.flush()
+        finally:
+            loop.close()
+        self.assertEqual(table.bank.balances, {winner.id: 110, loser.id: 5})
+        self.assertIn("<@2> can't cover a loss of 10 with 5 credits", "\n".join(table.output))
+
+
+class LeaderboardTest(unittest.TestCase):
+
+    def board(self, values, exact=False):
+        return blackjack.Leaderboard([(key, value, "p" + key) for key, value in values.items()], exact)
+
+    def test_highest_first_then_by_key(self):
+        board = self.board({"a": 5, "b": 9, "c": 5, "d": 1})
+        self.assertEqual(board.top(3), [("b", 9, "pb"), ("a", 5, "pa"), ("c", 5, "pc")])
+
+    def test_update_moves_a_player(self):
+        board = self.board({"a": 5, "b": 9, "c": 3})
+        board.update("c", 10, "pc")
+        board.update("b", 6, "pb")
+        self.assertEqual([key for key, value, name in board.top(3)], ["c", "b", "a"])
+
+    def test_newcomer_below_the_bottom_stays_out(self):
+        board = self.board({"a": 5, "b": 9})
+        board.update("z", 2, "pz") #someone not loaded could be ahead of them
+        board.update("y", 7, "py")
+        self.assertEqual([key for key, value, name in board.top(5)], ["b", "y", "a"])
+
+    def test_dropping_below_the_bottom_leaves_the_board(self):
+        board = self.board({"a": 5, "b": 9, "c": 3})
+        board.update("a", 1, "pa")
+        self.assertEqual(len(board), 2)
+        self.assertEqual([key for key, value, name in board.top(3)], ["b", "c"])
+
+    def test_exact_board_takes_everyone_up_to_its_size(self):
+        board = self.board({}, exact=True)
+        for i in range(blackjack.LEADERBOARD_SIZE + 5):
+            board.update("k{:02d}".format(i), i, "p")
+        self.assertEqual(len(board), blackjack.LEADERBOARD_SIZE)
+        self.assertFalse(board.exact)
+        self.assertEqual(board.top(1)[0][1], blackjack.LEADERBOARD_SIZE + 4)
+        self.assertEqual(board.top(blackjack.LEADERBOARD_SIZE)[-1][1], 5)
+
+
+class StatsStoreTest(DataFolderTest):
+
+    def setUp(self):
+        super().setUp()
+        self.store = blackjack.StatsStore(self.loop)
+        self.totals = {} #[(server, user)][stat]
+
+    def tearDown(self):
+        self.store.close()
+        super().tearDown()
+
+    def play(self, rng, rounds):
+        """Record rounds of random results, keeping the totals alongside"""
+        for _ in range(rounds):
+            results = []
+            for user in rng.sample(range(60), 4):
+                server = str(user % 2)
+                hands, blackjacks, net = rng.randint(1, 3), rng.randint(0, 1), rng.randint(-50, 50)
+                results.append((server, str(user), "p" + str(user), "9", 0, hands, 0, 0, 0, blackjacks, net))
+                totals = self.totals.setdefault((server, str(user)), dict.fromkeys(blackjack.STATS_RANKINGS, 0))
+                for stat, value in (("hands", hands), ("blackjacks", blackjacks), ("net", net), ("wins", 0)):
+                    totals[stat] += value
+            self.store.record(results)
+        self.loop.run_until_complete(self.loop.run_in_executor(self.store.executor, lambda: None)) #every write folded in
+
+    def expected(self, server, stat, count):
+        values = [totals[stat] for (playerserver, user), totals in self.totals.items() if server in (None, playerserver)]
+        return sorted(values, reverse=True)[:count]
+
+    def test_boards_match_the_totals(self):
+        rng = random.Random(4)
+        for _ in range(5):
+            self.play(rng, 40)
+            for server in ("0", "1", None):
+                for stat in ("net", "hands", "blackjacks"):
+                    top = self.loop.run_until_complete(self.store.leaderboard(server, stat, 10))
+                    self.assertEqual([value for key, value, name in top], self.expected(server, stat, 10), (server, stat))
+
+    def test_short_boards_reload(self):
+        size = blackjack.LEADERBOARD_SIZE
+        blackjack.LEADERBOARD_SIZE = 4 #so players soon drop off the bottom
+        loads = []
+        load = self.store._leaderboard
+        self.store._leaderboard = lambda server, stat: loads.append(stat) or load(server, stat)
+        try:
+            rng = random.Random(6)
+            for _ in range(10):
+                self.play(rng, 10)
+                top = self.loop.run_until_complete(self.store.leaderboard("0", "net", 4))
+                self.assertEqual([value for key, value, name in top], self.expected("0", "net", 4))
+        finally:
+            blackjack.LEADERBOARD_SIZE = size
+        self.assertGreater(len(loads), 1)
+
+    def test_global_board_keys(self):
+        self.play(random.Random(5), 20)
+        top = self.loop.run_until_complete(self.store.leaderboard(None, "net", 3))
+        for (server, user), value, name in top:
+            self.assertEqual(self.totals[(server, user)]["net"], value)
+            self.assertEqual(name, "p" + user)
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.outbox = blackjack.Outbox(blackjack.ReplayBot(self.loop), rate=1, per=60, workers=0)
+        self.channel = blackjack.ReplayChannel(1)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_held_message_counted_once(self):
+        for content in ("a", "b", "c"):
+            self.outbox.send(self.channel, content)
+        self.assertEqual(self.outbox.next_ready()[1][2], "a")
+        for _ in range(5):
+            self.assertIsNone(self.outbox.next_ready()[0])
+        self.assertEqual(self.outbox.limited, 1) #b; c hasn't reached the front yet
+
+    def test_newer_render_replaces_a_queued_one(self):
+        table = blackjack.ReplayTable(self.loop)
+        table.outbox = self.outbox
+        session = blackjack.BlackjackSession(blackjack.ReplayMessage(self.channel), dict(blackjack.DEFAULT_SETTINGS),
+                                             seed=1, manager=table)
+        session.shoe = blackjack.shuffled_shoe(1, 75, 1)
+        session.shoe.cards[-2:] = [card(3), card(2)]
+        player = blackjack.ReplayUser(1)
+        session.activeUser = player
+        hand = blackjack.restore_hand(player, False, 10, [card(2), card(2)])
+        session.hands[player] = [hand]
+        self.outbox.send(self.channel, "ahead of the table") #holds the renders in the queue
+        self.outbox.next_ready()
+        self.loop.run_until_complete(session.do_hit(0))
+        self.loop.run_until_complete(session.do_hit(0))
+        queued = [item[2] for item in self.outbox.channels[self.channel.id].pending]
+        self.assertEqual(queued, [str(hand)])
+        self.assertEqual(self.outbox.merged, 1)
+
+
+class ShoeTest(unittest.TestCase):
+
+    def test_rebuild_leaves_out_cards_in_play(self):
+        shoe = blackjack.shuffled_shoe(1, 75, 1)
+        for _ in range(40):
+            shoe.pop_card()
+        shoe.new_round()
+        inplay = [shoe.pop_card() for _ in range(14)]  #the last 12, then two from the rebuilt shoe
+        self.assertEqual(len(set(inplay)), len(inplay))
+        self.assertEqual(len(shoe) + len(inplay), 52)
+        self.assertFalse(set(inplay) & set(shoe.cards))
+        self.assertTrue(shoe.cut_reached())
+
+    def test_same_seed_same_rebuild(self):
+        def deal(seed):
+            shoe = blackjack.shuffled_shoe(2, 90, seed)
+            for _ in range(100):
+                shoe.pop_card()
+            shoe.new_round()
+            return [shoe.pop_card() for _ in range(10)]
+        self.assertEqual(deal(5), deal(5))
+
+
+class HandTest(unittest.TestCase):
+
+    def test_deck_deals_into_a_hand(self):
+        deck = blackjack.Deck()
+        deck.cards = [blackjack.Card(3, 13), blackjack.Card(0, 1)]  #dealt from the end
+        hand = blackjack.Hand(blackjack.ReplayUser(1))
+        deck.move_cards(hand, 2)
+        self.assertEqual(list(hand.cards), [0, 51])  #ace of clubs, king of spades
+        self.assertTrue(hand.isBlackjack)
+        self.assertEqual(str(hand), "player1's hand: :a: :clubs: :mens: :spades:  Total: 21 !!")
+        self.assertFalse(deck.cards)
+
+    def test_shoe_and_deck_cards_match(self):
+        deck = blackjack.Deck()
+        hand = blackjack.Hand(blackjack.ReplayUser(1))
+        deck.move_cards(hand, 52)
+        shoe = blackjack.Shoe()
+        self.assertEqual(sorted(hand.cards), sorted(shoe.cards))
+        self.assertEqual(sorted(hand.names), sorted(blackjack.CARD_NAMES))
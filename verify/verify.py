@@ -1,7 +1,23 @@
 import discord
 from discord.ext import commands
 from cogs.utils import checks
+from cogs.utils.dataIO import fileIO
 from __main__ import settings
+from collections import deque
+import asyncio
+import datetime
+import logging
+import os
+
+ROLE_CONCURRENCY = 4 #role changes in flight at once, across every command
+PROGRESS_INTERVAL = 2 #seconds between edits of a bulk verification's progress message
+JOIN_QUEUE_SIZE = 5000 #members waiting for auto verification before new joins are turned away
+JOIN_WORKERS = 2
+SETTINGS_FILE = "data/verify/settings.json"
+DEFAULT_SETTINGS = {"BATCH_SIZE": 10, "BATCH_DELAY": 5, "SERVERS": {}} #SERVERS: [server id]{"ROLE", "MIN_AGE"}
+STAT_NAMES = ("verified", "held", "failed", "turned away", "most queued")
+
+logger = logging.getLogger("red.verify")
 
 
 class Verify:
@@ -9,6 +25,261 @@ class Verify:
 
     def __init__(self, bot):
         self.bot = bot
+        self.roles = {} #[server id][lowercased role name]role
+        self.perms = {} #[server id][channel id]whether the bot can manage roles there
+        self.rolelimit = asyncio.BoundedSemaphore(ROLE_CONCURRENCY)
+        self.settings = fileIO(SETTINGS_FILE, "load")
+        self.joinqueue = asyncio.Queue(maxsize=JOIN_QUEUE_SIZE) #members who joined a server with auto verification on
+        self.queued = {} #[server id]members of that server in the join queue
+        self.stats = {} #[server id]{STAT_NAMES}
+        self.workers = [bot.loop.create_task(self.auto_verify()) for _ in range(JOIN_WORKERS)]
+
+    def __unload(self):
+        for worker in self.workers:
+            worker.cancel()
+
+    def find_role(self, server, rolename):
+        """O(1) role lookup by case-insensitive name.  The index is built on
+           first use and dropped by the role and member events below."""
+        index = self.roles.get(server.id)
+        if index is None:
+            index = {}
+            for role in server.roles:
+                index.setdefault(role.name.lower(), role) #first match wins, as with discord.utils.find
+            self.roles[server.id] = index
+        return index.get(rolename.lower())
+
+    def can_manage_roles(self, channel):
+        """Cached channel.permissions_for(server.me).manage_roles"""
+        server_perms = self.perms.setdefault(channel.server.id, {})
+        manage = server_perms.get(channel.id)
+        if manage is None:
+            manage = channel.permissions_for(channel.server.me).manage_roles
+            server_perms[channel.id] = manage
+        return manage
+
+    def server_stats(self, server):
+        stats = self.stats.get(server.id)
+        if stats is None:
+            stats = dict.fromkeys(STAT_NAMES, 0)
+            self.stats[server.id] = stats
+        return stats
+
+    def invalidate(self, server):
+        self.roles.pop(server.id, None)
+        self.perms.pop(server.id, None)
+
+    async def on_server_role_create(self, role):
+        self.invalidate(role.server)
+
+    async def on_server_role_delete(self, role):
+        self.invalidate(role.server)
+
+    async def on_server_role_update(self, before, after):
+        self.invalidate(after.server)
+
+    async def on_member_update(self, before, after):
+        if after.id == self.bot.user.id: #the bot's own roles decide its permissions
+            self.perms.pop(after.server.id, None)
+
+    async def on_channel_update(self, before, after):
+        if not after.is_private:
+            self.perms.get(after.server.id, {}).pop(after.id, None)
+
+    async def on_channel_delete(self, channel):
+        if not channel.is_private:
+            self.perms.get(channel.server.id, {}).pop(channel.id, None)
+
+    async def on_server_remove(self, server):
+        self.invalidate(server)
+
+    async def on_member_join(self, member):
+        if member.server.id not in self.settings["SERVERS"]:
+            return
+        stats = self.server_stats(member.server)
+        if self.joinqueue.full(): #verifyme still works for them
+            stats["turned away"] += 1
+            return
+        self.joinqueue.put_nowait(member)
+        queued = self.queued.get(member.server.id, 0) + 1
+        self.queued[member.server.id] = queued
+        stats["most queued"] = max(stats["most queued"], queued)
+
+    async def auto_verify(self):
+        """Worker draining the join queue in batches of BATCH_SIZE, resting
+           BATCH_DELAY seconds after each so a join wave is spread out"""
+        while True:
+            batch = [await self.joinqueue.get()]
+            while len(batch) < self.settings["BATCH_SIZE"] and not self.joinqueue.empty():
+                batch.append(self.joinqueue.get_nowait())
+            for member in batch:
+                self.queued[member.server.id] -= 1
+            for member in batch:
+                try:
+                    await self.verify_joined(member)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.server_stats(member.server)["failed"] += 1
+                    logger.exception("Auto verification of {} in {} failed".format(member.id, member.server.id))
+            await asyncio.sleep(self.settings["BATCH_DELAY"])
+
+    async def verify_joined(self, member):
+        """The verifyme path for a queued member, if they still qualify"""
+        config = self.settings["SERVERS"].get(member.server.id)
+        if config is None:
+            return
+        member = member.server.get_member(member.id) #as they are now, with any roles given since they joined
+        if member is None: #they left
+            return
+        role = self.find_role(member.server, config["ROLE"])
+        if role is None or role in member.roles:
+            return
+        stats = self.server_stats(member.server)
+        if (datetime.datetime.utcnow() - member.created_at).days < config["MIN_AGE"]:
+            stats["held"] += 1 #too new; a mod can verify them
+            return
+        try:
+            await self.add_role(member, role)
+            stats["verified"] += 1
+        except discord.HTTPException as e:
+            stats["failed"] += 1
+            logger.info("Auto verification of {} in {} failed: {}".format(member.id, member.server.id, str(e)))
+
+    @commands.group(no_pm=True, pass_context=True)
+    @checks.mod_or_permissions(manage_roles=True)
+    async def verifyauto(self, ctx):
+        """Verifies members automatically when they join"""
+        if ctx.invoked_subcommand is None:
+            server = ctx.message.server
+            config = self.settings["SERVERS"].get(server.id)
+            if config is None:
+                msg = "Auto verification is off here."
+            else:
+                msg = "Auto verification gives {} to members whose accounts are at least {} days old.".format(
+                    config["ROLE"], str(config["MIN_AGE"]))
+            msg += "\n```Queued: {} (all servers: {} of {})\n".format(
+                str(self.queued.get(server.id, 0)), str(self.joinqueue.qsize()), str(JOIN_QUEUE_SIZE))
+            msg += "Batches of {} every {} seconds\n".format(str(self.settings["BATCH_SIZE"]), str(self.settings["BATCH_DELAY"]))
+            for k, v in sorted(self.server_stats(server).items()):
+                msg += k.capitalize() + ": " + str(v) + "\n"
+            msg += "\nType {}help verifyauto to see the list of commands.```".format(ctx.prefix)
+            await self.bot.say(msg)
+
+    @verifyauto.command(name="on", pass_context=True)
+    async def auto_on(self, ctx, rolename: str="Verified"):
+        """Give new members the specified role"""
+        server = ctx.message.server
+        role = self.find_role(server, rolename)
+        if role is None:
+            await self.bot.say('The "{}" role cannot be found.'.format(rolename))
+            return
+        if not server.me.server_permissions.manage_roles:
+            await self.bot.say('I don\'t have manage_roles permissions.')
+            return
+        config = self.settings["SERVERS"].setdefault(server.id, {"MIN_AGE": 0})
+        config["ROLE"] = role.name
+        fileIO(SETTINGS_FILE, "save", self.settings)
+        await self.bot.say("New members will get the {} role.".format(role.name))
+
+    @verifyauto.command(name="off", pass_context=True)
+    async def auto_off(self, ctx):
+        """Stop verifying new members"""
+        self.settings["SERVERS"].pop(ctx.message.server.id, None)
+        fileIO(SETTINGS_FILE, "save", self.settings)
+        await self.bot.say("Auto verification is off.")
+
+    @verifyauto.command(name="minage", pass_context=True)
+    async def auto_minage(self, ctx, days: int):
+        """Only verify accounts at least this many days old"""
+        config = self.settings["SERVERS"].get(ctx.message.server.id)
+        if config is None:
+            await self.bot.say("Turn auto verification on first.")
+            return
+        if days < 0:
+            await self.bot.say("Minimum account age can't be negative.")
+            return
+        config["MIN_AGE"] = days
+        fileIO(SETTINGS_FILE, "save", self.settings)
+        await self.bot.say("Accounts must be {} days old to be verified automatically.".format(str(days)))
+
+    @verifyauto.command(name="pace", pass_context=True)
+    @checks.is_owner()
+    async def auto_pace(self, ctx, batch: int, seconds: int):
+        """Members per batch, and seconds between batches, for every server"""
+        if batch < 1 or seconds < 0:
+            await self.bot.say("Batches need at least 1 member and a delay of 0 or more seconds.")
+            return
+        self.settings["BATCH_SIZE"] = batch
+        self.settings["BATCH_DELAY"] = seconds
+        fileIO(SETTINGS_FILE, "save", self.settings)
+        await self.bot.say("Auto verification now works in batches of {} every {} seconds.".format(str(batch), str(seconds)))
+
+    async def add_role(self, member, role):
+        """add_roles, holding one of the ROLE_CONCURRENCY slots.  discord.py
+           waits out any rate limit inside the call, so the slot stays held."""
+        async with self.rolelimit:
+            await self.bot.add_roles(member, role)
+
+    @commands.command(no_pm=True, pass_context=True)
+    @checks.mod_or_permissions(manage_roles=True)
+    async def verifybulk(self, ctx, rolename: str="Verified", *, who: str="all"):
+        """Adds the specified role to many members at once
+
+        who is "all" for every member without the role, the name of a role
+        whose members should all get it, or mentions of the members."""
+        channel = ctx.message.channel
+        server = ctx.message.server
+        role = self.find_role(server, rolename)
+        if role is None:
+            await self.bot.say('Something went wrong.  The "{}" role cannot be found.'.format(rolename))
+            return
+        if not self.can_manage_roles(channel):
+            await self.bot.say('I don\'t have manage_roles permissions.')
+            return
+
+        if ctx.message.mentions:
+            members = ctx.message.mentions
+        elif who.lower() == "all":
+            members = list(server.members)
+        else:
+            having = self.find_role(server, who)
+            if having is None:
+                await self.bot.say('The "{}" role cannot be found.'.format(who))
+                return
+            members = [member for member in server.members if having in member.roles]
+        todo = deque(member for member in members if role not in member.roles)
+        skipped = len(members) - len(todo)
+        total = len(todo)
+        added = []
+        failed = [] #(member, reason)
+
+        async def worker():
+            while todo:
+                member = todo.popleft()
+                try:
+                    await self.add_role(member, role)
+                    added.append(member)
+                except discord.HTTPException as e:
+                    failed.append((member, type(e).__name__))
+
+        def status():
+            return "Verifying with {}: {} of {} done, {} failed, {} already had it.".format(
+                role.name, str(len(added) + len(failed)), str(total), str(len(failed)), str(skipped))
+
+        progress = await self.bot.say(status())
+        work = asyncio.gather(*[worker() for _ in range(min(ROLE_CONCURRENCY, total))])
+        while not work.done():
+            await asyncio.wait([work], timeout=PROGRESS_INTERVAL)
+            if not work.done():
+                progress = await self.bot.edit_message(progress, status())
+        msg = "Added role {} to {} members.  {} already had it.".format(role.name, str(len(added)), str(skipped))
+        if failed:
+            msg += "  {} failed: ".format(str(len(failed)))
+            msg += ", ".join("{} ({})".format(member.name, reason) for member, reason in failed)
+            if len(msg) > 1900:
+                msg = msg[:1900] + "..."
+        await self.bot.edit_message(progress, msg)
 
     @commands.command(no_pm=True, pass_context=True)
     async def verifyme(self, ctx, rolename: str="Verified", user: discord.Member=None):
@@ -16,8 +287,7 @@ class Verify:
         author = ctx.message.author
         channel = ctx.message.channel
         server = ctx.message.server
-        role = discord.utils.find(lambda r: r.name.lower() == rolename.lower(),
-                                  ctx.message.server.roles)
+        role = self.find_role(server, rolename)
         if user is None:
             user = author
 
@@ -25,14 +295,31 @@ class Verify:
             await self.bot.say('Something went wrong.  The "Verified" role cannot be found.')
             return
 
-        if not channel.permissions_for(server.me).manage_roles:
+        if not self.can_manage_roles(channel):
             await self.bot.say('I don\'t have manage_roles permissions.')
             return
 
-        await self.bot.add_roles(user, role)
+        await self.add_role(user, role)
         await self.bot.say('Added role {} to {}'.format(role.name, user.name))
 
-def setup(bot):
-    bot.add_cog(Verify(bot))
+def check_folders():
+    if not os.path.exists("data/verify"):
+        print("Creating data/verify folder...")
+        os.makedirs("data/verify")
 
+def check_files():
+    if not fileIO(SETTINGS_FILE, "check"):
+        print("Creating default verify's settings.json...")
+        fileIO(SETTINGS_FILE, "save", DEFAULT_SETTINGS)
+    else: #consistency check
+        current = fileIO(SETTINGS_FILE, "load")
+        if current.keys() != DEFAULT_SETTINGS.keys():
+            for key in DEFAULT_SETTINGS.keys():
+                if key not in current.keys():
+                    current[key] = DEFAULT_SETTINGS[key]
+            fileIO(SETTINGS_FILE, "save", current)
 
+def setup(bot):
+    check_folders()
+    check_files()
+    bot.add_cog(Verify(bot))